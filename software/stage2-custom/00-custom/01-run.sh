@@ -6,6 +6,7 @@ install -d -m 755 -o 1000 -g 1000 "${ROOTFS_DIR}/home/${FIRST_USER_NAME}/data"
 install -m 644 files/configs/10-udisks.pkla "${ROOTFS_DIR}/etc/polkit-1/localauthority/50-local.d"
 install -m 644 files/configs/99-iio.rules "${ROOTFS_DIR}/etc/udev/rules.d"
 install -m 644 files/configs/impedance.service "${ROOTFS_DIR}/etc/systemd/system"
+install -m 644 files/configs/impedance-protocol.service "${ROOTFS_DIR}/etc/systemd/system"
 cp -r files/kernel "${ROOTFS_DIR}/tmp/"
 
 install -m 644 files/autossh/autossh.service "${ROOTFS_DIR}/etc/systemd/system"
@@ -24,6 +25,7 @@ EOF
 
 on_chroot <<EOF
 sed -i "s/{USER}/${FIRST_USER_NAME}/" /etc/systemd/system/impedance.service
+sed -i "s/{USER}/${FIRST_USER_NAME}/g" /etc/systemd/system/impedance-protocol.service
 systemctl enable impedance
 
 echo "i2c-dev" >> /etc/modules
@@ -2,15 +2,31 @@
 
 # Copyright (c) 2024 David Schiller <david.schiller@jku.at>
 
+import errno
+import json
 import logging
+import os
+import re
 import struct
-from math import atan2, pi, sqrt
-from statistics import mean, stdev
-
-import iio
-from scipy.interpolate import UnivariateSpline
-
-from adg729 import ADG729
+from collections import deque
+from math import atan2, ceil, pi, sqrt
+from queue import Queue
+from statistics import mean
+from threading import Event, Thread
+
+import numpy as np
+
+try:
+    import iio
+except ImportError:
+    # only needed on the instrument, replay.py stands in elsewhere
+    iio = None
+
+import metrics
+from adg729 import ADG729, ADG729_ADDR
+from i2c import RASPI_BUS, I2CBus
+from interp import INTERPOLATORS
+from stats import average_sweeps
 
 # maybe use an enum here
 OUTPUT_VOLTAGES = ("1980", "970", "383", "198")
@@ -43,37 +59,178 @@ CAL_FREQS = sorted(
     )
 )
 TIMEOUT = 600000  # 10 minutes
+# libiio's default, the kernel buffer holds this many refills
+KERNEL_BUFFERS = 4
 SAMPLES_PER_POINT = 3 - 1
 SMOOTH = 0
+# calibration interpolation engine, see interp.py
+INTERPOLATION = "spline"
 CLOCK_FREQ = 9e6
 LOWER_CLOCK_LIMIT = 22500
+SETTLING_CYCLES = 10
+# driver timing, see AD5933_INIT_EXCITATION_TIME_ms and AD5933_POLL_TIME_ms
+INIT_EXCITATION_TIME = 0.1
+POLL_TIME = 0.01
+# calibrations closer than this (in °C) replace each other
+TEMP_TOLERANCE = 1.0
+# adaptive calibration: relative gain error and phase error in rad, raised to
+# NOISE_FACTOR times the noise of a calibration point, which is estimated
+# from NOISE_REPEATS extra measurements of one coarse point
+GAIN_TOLERANCE = 1e-3
+PHASE_TOLERANCE = 2e-3
+NOISE_FACTOR = 3
+NOISE_REPEATS = 4
+COARSE_CAL_POINTS = 12
+MAX_CAL_POINTS = 150
+# calibration verification: points checked, allowed relative gain and phase
+# (rad) drift, and the share of drifted points that calls for a full
+# recalibration
+VERIFY_POINTS = 8
+VERIFY_GAIN_TOLERANCE = 3e-3
+VERIFY_PHASE_TOLERANCE = 5e-3
+VERIFY_FULL_FRACTION = 0.5
+# excitation frequency limit of the AD5933
+MAX_FREQ = 100000
+CAL_GRID_FILE = os.path.expanduser("~/.config/impedance/cal_grids.json")
+# MCLK choices for multi-clock sweeps, fastest first
+BAND_CLOCKS = (9000000, 2250000, 562500, 140625, LOWER_CLOCK_LIMIT)
 
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
 
+def clock_limits(clock):
+    # lowest and highest usable excitation frequency for a given MCLK,
+    # ADC sample rate is 1/16 of MCLK, divide by two due to Nyquist
+    # TODO: elaborate on formulas
+    adc_rate = clock / 16
+    return max(1, int(adc_rate / 1000)), min(int(adc_rate / 2) - 1, MAX_FREQ)
+
+
+def log_spaced(start, stop, points):
+    return sorted(set(int(round(f)) for f in np.geomspace(start, stop, points)))
+
+
+def plan_bands(freqs, clocks=BAND_CLOCKS):
+    # assign every frequency to the fastest clock that can measure it, the
+    # bands are returned in ascending frequency order
+    bands = {}
+    for f in sorted(set(freqs)):
+        for clock in sorted(clocks, reverse=True):
+            low, high = clock_limits(clock)
+            if low <= f <= high:
+                bands.setdefault(clock, []).append(f)
+                break
+        else:
+            logger.warning(f"no clock can measure {f} Hz, skipping")
+    return sorted(bands.items(), key=lambda band: band[1][0])
+
+
+def point_time(f, clock, settling_cycles=SETTLING_CYCLES):
+    # settling plus a 1024-sample DFT at MCLK / 16, the driver only notices
+    # new data at its polling period
+    t = settling_cycles / max(f, 1) + 1024 * 16 / clock
+    return ceil(t / POLL_TIME) * POLL_TIME
+
+
+def sweep_time(start, increment, points, clock, settling_cycles=SETTLING_CYCLES):
+    # estimated duration of one hardware sweep
+    return INIT_EXCITATION_TIME + sum(
+        point_time(start + increment * i, clock, settling_cycles)
+        for i in range(points + 1)
+    )
+
+
+def wrap_phase(phase):
+    return (phase + pi) % (2 * pi) - pi
+
+
+def linear_runs(freqs):
+    # split sorted frequencies into hardware sweeps with a constant increment
+    runs = []
+    for f in freqs:
+        run = runs[-1] if runs else None
+        if run and len(run) < 512 and (len(run) == 1 or f - run[-1] == run[1] - run[0]):
+            run.append(f)
+        else:
+            runs.append([f])
+    return runs
+
+
+def find_devices(ctx):
+    # ids of all AD5933 boards, the address is fixed so each has its own bus
+    return [dev.id for dev in ctx.devices if dev.name == "ad5933"]
+
+
+def device_bus(dev):
+    # I2C bus number from the sysfs path of the IIO device
+    path = os.path.realpath(f"/sys/bus/iio/devices/{dev.id}")
+    match = re.search(r"/i2c-(\d+)/", path)
+    return int(match.group(1)) if match else RASPI_BUS
+
+
 class AD5933:
-    def __init__(self, cal_freqs=CAL_FREQS):
+    def __init__(
+        self, cal_freqs=CAL_FREQS, device=None, mux_addr=ADG729_ADDR, backend=iio
+    ):
         self.cal_freqs = cal_freqs
-        self.mux = ADG729()
-        self.ctx = iio.Context()
+        # libiio or a stand-in with the same Context and Buffer, see replay.py
+        if backend is None:
+            raise RuntimeError(
+                "libiio is not installed, pass a backend such as "
+                "simulator.SimulatedBoard or replay.Replayer.iio()"
+            )
+        self.backend = backend
+        self.ctx = backend.Context()
         self.ctx.set_timeout(TIMEOUT)
-        self.dev = self.ctx.find_device("ad5933")
+        # first board unless an IIO device id is given
+        self.dev = self.ctx.find_device(device or "ad5933")
         assert self.dev is not None
+        self.mux = ADG729(device_bus(self.dev), mux_addr)
+        self.bus = I2CBus.get(device_bus(self.dev))
+        if device is None:
+            self.name = "ad5933"
+            self.cal_grid_file = CAL_GRID_FILE
+        else:
+            self.name = f"ad5933@{device}"
+            self.cal_grid_file = CAL_GRID_FILE.replace(".json", f"-{device}.json")
         # channels
         self.real = self.dev.find_channel("voltage_real")
         self.imag = self.dev.find_channel("voltage_imag")
         self.output = self.dev.find_channel("altvoltage0", is_output=True)
         self.input = self.dev.find_channel("voltage0")
+        # last value written to each attribute
+        self._attr_values = {}
+        self.settling_cycles = SETTLING_CYCLES
+        self.samples_per_point = SAMPLES_PER_POINT
+        self.smooth = SMOOTH
+        self.interpolation = INTERPOLATION
+        # fitted gain and phase interpolants by (name, range)
+        self._interpolants = {}
         self.range = 1
         self.gain_parameters = {1: [], 2: [], 3: [], 4: []}
         self.phase_offsets = {1: [], 2: [], 3: [], 4: []}
+        # frequencies each range was calibrated at
+        self.cal_frequencies = {1: [], 2: [], 3: [], 4: []}
+        # adaptively chosen grids by (range, clock frequency)
+        self.cal_grids = {}
+        # complete calibrations by (clock frequency, range)
+        self.calibrations = {}
+        self._clock = None
+        # calibrations taken at different board temperatures
+        self.cal_snapshots = {1: [], 2: [], 3: [], 4: []}
+        self.temp_compensation = True
+        self._surfaces = {}
+        self._cal_temp = None
+        # (frequency, gain ratio, phase offset) from the last reference check
+        self.drift = None
 
     @property
     def temp(self):
         temp = self.dev.find_channel("temp")
-        return int(temp.attrs["raw"].value) * float(temp.attrs["scale"].value) / 1000.0
+        raw = self.bus.transaction(self.name, lambda: temp.attrs["raw"].value)
+        return int(raw) * float(temp.attrs["scale"].value) / 1000.0
 
     @property
     def clock_frequency(self):
@@ -83,6 +240,17 @@ class AD5933:
     def clock_frequency(self, f):
         assert f >= LOWER_CLOCK_LIMIT
         self.dev.attrs["clock_frequency"].value = f"{int(f)}"
+        self._clock = int(f)
+        # frequency registers are derived from MCLK when written
+        self._attr_values.clear()
+
+    @property
+    def clock(self):
+        # the clock driver may round, so calibrations are keyed by the rate
+        # that was asked for
+        if self._clock is None:
+            self._clock = self.clock_frequency
+        return self._clock
 
     @property
     def range(self):
@@ -95,61 +263,362 @@ class AD5933:
         self._set_gain(RANGES[index][1])
         self._set_output_voltage(RANGES[index][2])
         self._range = index
+        self.drift = None
 
     @property
     def cal_freqs(self):
-        # ADC sample rate is 1/16 of MCLK
-        adc_rate = self.clock_frequency / 16
-        # divide by two due to Nyquist
-        # TODO: elaborate on formulas
-        return [
-            f
-            for f in self._cal_freqs
-            if f in range(int(adc_rate / 1000), int(adc_rate / 2))
-        ]
+        low, high = self.freq_limits
+        return [f for f in self._cal_freqs if low <= f <= high]
 
     @cal_freqs.setter
     def cal_freqs(self, freqs):
         self._cal_freqs = freqs
 
-    def cal_range(self, index):
+    @property
+    def freq_limits(self):
+        return clock_limits(self.clock_frequency)
+
+    def cal_range(self, index, accumulate=False, freqs=None):
+        assert index in range(1, len(CAL_RANGES) + 1)
+        freqs = self.cal_freqs if freqs is None else sorted(freqs)
+        self._select_cal(index)
+
+        temp = self.temp
+        gain = []
+        phase = []
+        for f in freqs:
+            gain_, phase_ = self._cal_point(index, f)
+            gain.append(gain_)
+            phase.append(phase_)
+        self._store_cal(index, temp, freqs, gain, phase, accumulate)
+
+    def cal_range_adaptive(
+        self,
+        index,
+        accumulate=False,
+        gain_tolerance=GAIN_TOLERANCE,
+        phase_tolerance=PHASE_TOLERANCE,
+        max_points=MAX_CAL_POINTS,
+    ):
+        # refine a coarse log-spaced grid only where the interpolation of
+        # the gain/phase curves misses a newly measured midpoint
         assert index in range(1, len(CAL_RANGES) + 1)
+        low, high = self.freq_limits
+        coarse = sorted(
+            set(int(round(f)) for f in np.geomspace(low, high, COARSE_CAL_POINTS))
+        )
+        self._select_cal(index)
+
+        temp = self.temp
+        points = {f: self._cal_point(index, f) for f in coarse}
+        # a midpoint can't be predicted better than it is measured
+        f = coarse[len(coarse) // 2]
+        repeats = np.array(
+            [points[f]] + [self._cal_point(index, f) for _ in range(NOISE_REPEATS)]
+        )
+        gain, phase = repeats.mean(axis=0)
+        gain_noise = repeats[:, 0].std(ddof=1) / abs(gain)
+        phase_noise = wrap_phase(repeats[:, 1] - phase).std(ddof=1)
+        gain_tolerance = max(gain_tolerance, NOISE_FACTOR * gain_noise)
+        phase_tolerance = max(phase_tolerance, NOISE_FACTOR * phase_noise)
+        logger.debug(
+            f"adaptive calibration tolerances: gain {gain_tolerance:.2e}, "
+            f"phase {phase_tolerance:.2e} rad"
+        )
+        points[f] = (gain, phase)
+        intervals = deque(zip(coarse, coarse[1:]))
+        while intervals and len(points) < max_points:
+            a, b = intervals.popleft()
+            f = int(round(sqrt(a * b)))
+            if f in points or f in (a, b):
+                continue
+            freqs = sorted(points)
+            gain_ = self._interpolant(freqs, [points[i][0] for i in freqs])(f)
+            phase_ = self._interpolant(freqs, [points[i][1] for i in freqs])(f)
+            points[f] = self._cal_point(index, f)
+            gain_error = abs(gain_ - points[f][0]) / abs(points[f][0])
+            phase_error = abs(wrap_phase(phase_ - points[f][1]))
+            if gain_error > gain_tolerance or phase_error > phase_tolerance:
+                intervals.extend(((a, f), (f, b)))
+        if intervals:
+            logger.warning(f"adaptive calibration stopped at {max_points} points")
+
+        freqs = sorted(points)
+        self.cal_grids[(index, self.clock)] = freqs
+        logger.debug(f"adaptive calibration of range {index}: {len(freqs)} points")
+        self._store_cal(
+            index,
+            temp,
+            freqs,
+            [points[f][0] for f in freqs],
+            [points[f][1] for f in freqs],
+            accumulate,
+        )
+
+    def verify_range(self, index, accumulate=False, points=VERIFY_POINTS):
+        # measures a few calibration frequencies on the reference resistor
+        # and re-measures only the regions around those that drifted from the
+        # stored model, a full calibration only if most of them did
+        assert index in range(1, len(CAL_RANGES) + 1)
+        freqs = self.cal_frequencies[index]
+        if not freqs:
+            logger.info(f"range {index} is not calibrated at {self.clock} Hz")
+            self.cal_range(index, accumulate)
+            return {"checked": 0, "drifted": [], "measured": len(self.cal_freqs)}
+        self.range = index
+        self._update_temp()
+        checked = sorted(
+            set(freqs[round(i)] for i in np.linspace(0, len(freqs) - 1, points))
+        )
+        temp = self.temp
+        self._select_cal(index)
+        try:
+            measured = {f: self._cal_point(index, f) for f in checked}
+        finally:
+            self.range = index
+        drifted = [
+            f
+            for f, (gain, phase) in measured.items()
+            if abs(gain / self._gain(f) - 1) > VERIFY_GAIN_TOLERANCE
+            or abs(wrap_phase(phase - self._phase(f))) > VERIFY_PHASE_TOLERANCE
+        ]
+        result = {"checked": len(checked), "drifted": drifted, "measured": 0}
+        if len(drifted) > VERIFY_FULL_FRACTION * len(checked):
+            logger.info(f"range {index}: {len(drifted)} points drifted, recalibrating")
+            self.cal_range(index, accumulate, freqs)
+            result["measured"] = len(freqs)
+            return result
+        if not drifted:
+            return result
+        # a checked point stands for the calibration frequencies up to the
+        # geometric midpoints to its neighbours
+        bounds = [0, *(sqrt(a * b) for a, b in zip(checked, checked[1:])), np.inf]
+        regions = [
+            (bounds[i], bounds[i + 1]) for i, f in enumerate(checked) if f in drifted
+        ]
+        stale = [f for f in freqs if any(low < f <= high for low, high in regions)]
+        gain, phase = (list(values) for values in self._cal_parameters())
+        self._select_cal(index)
+        try:
+            for i, f in enumerate(freqs):
+                if f in measured:
+                    gain[i], phase[i] = measured[f]
+                elif f in stale:
+                    gain[i], phase[i] = self._cal_point(index, f)
+                    result["measured"] += 1
+        finally:
+            self.range = index
+        logger.info(
+            f"range {index}: refitted {len(stale)} of {len(freqs)} points "
+            f"around {drifted} Hz"
+        )
+        self._store_cal(index, temp, list(freqs), gain, phase, accumulate)
+        return result
+
+    def cal_grid(self, index):
+        # stored adaptive grid, if it is valid for the current clock
+        return self.cal_grids.get((index, self.clock))
+
+    def save_cal_grids(self, filename=None):
+        filename = filename or self.cal_grid_file
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as fh:
+            json.dump(
+                [
+                    {"range": index, "clock": clock, "freqs": freqs}
+                    for (index, clock), freqs in self.cal_grids.items()
+                ],
+                fh,
+            )
+
+    def load_cal_grids(self, filename=None):
+        filename = filename or self.cal_grid_file
+        try:
+            with open(filename) as fh:
+                grids = json.load(fh)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logger.warning(f"ignoring corrupt calibration grid file: {e}")
+            return
+        for grid in grids:
+            self.cal_grids[(grid["range"], grid["clock"])] = grid["freqs"]
+
+    def _select_cal(self, index):
         self.mux.write(*CAL_RANGES[index][0])
         self._set_gain(CAL_RANGES[index][1])
         self._set_output_voltage(CAL_RANGES[index][2])
 
-        gain = []
-        phase = []
-        for f in self.cal_freqs:
-            data = self._raw_sweep(f, 0, SAMPLES_PER_POINT)
-            real = mean(data["real"])
-            imag = mean(data["imag"])
-            magnitude = sqrt(real ** 2 + imag ** 2)
-            gain.append(1 / CAL_RANGES[index][3] / magnitude)
-            phase.append(atan2(imag, real))
+    def _cal_point(self, index, f):
+        data = self._raw_sweep(f, 0, self.samples_per_point)
+        real = mean(data["real"])
+        imag = mean(data["imag"])
+        magnitude = sqrt(real ** 2 + imag ** 2)
+        return 1 / CAL_RANGES[index][3] / magnitude, atan2(imag, real)
+
+    def _store_cal(self, index, temp, freqs, gain, phase, accumulate):
+        # the die warms up during long calibrations
+        temp = (temp + self.temp) / 2
+        self.cal_frequencies[index] = freqs
         self.gain_parameters[index] = gain
         self.phase_offsets[index] = phase
+        self._add_snapshot(index, temp, freqs, gain, phase, accumulate)
+        self.calibrations[(self.clock, index)] = {
+            "freqs": freqs,
+            "gain": gain,
+            "phase": phase,
+            "snapshots": self.cal_snapshots[index],
+        }
         self.range = index
 
-    def _gain(self, frequency):
-        spline = UnivariateSpline(
-            self.cal_freqs,
-            self.gain_parameters[self._range],
-            s=SMOOTH,
-            k=3,
-            w=[2 / stdev(self.gain_parameters[self._range])] * len(self.cal_freqs),
+    def _add_snapshot(self, index, temp, freqs, gain, phase, accumulate):
+        snapshot = {"T": temp, "freqs": freqs, "gain": gain, "phase": phase}
+        if accumulate:
+            # only snapshots on the same clock and frequency grid can be combined
+            previous = self.calibrations.get((self.clock, index), {})
+            snapshots = [
+                s
+                for s in previous.get("snapshots", [])
+                if s["freqs"] == snapshot["freqs"]
+                and abs(s["T"] - temp) >= TEMP_TOLERANCE
+            ]
+        else:
+            snapshots = []
+        snapshots.append(snapshot)
+        snapshots.sort(key=lambda s: s["T"])
+        self.cal_snapshots[index] = snapshots
+        self._surfaces.pop(index, None)
+        self._interpolants.clear()
+        logger.debug(
+            f"range {index} calibrated at {temp:.1f} °C "
+            f"({len(snapshots)} temperature(s) on record)"
         )
-        return spline(frequency)
 
-    def _phase(self, frequency):
-        spline = UnivariateSpline(
-            self.cal_freqs,
-            self.phase_offsets[self._range],
-            s=SMOOTH,
-            k=3,
-            w=[2 / stdev(self.phase_offsets[self._range])] * len(self.cal_freqs),
+    def _update_temp(self, temp=None):
+        if self.temp_compensation and len(self.cal_snapshots[self._range]) > 1:
+            self._cal_temp = self.temp if temp is None else temp
+
+    def _blend(self):
+        # snapshots i - 1 and i around the board temperature and the weight
+        # of snapshot i, None without temperature compensation
+        snapshots = self.cal_snapshots[self._range]
+        if not self.temp_compensation or len(snapshots) < 2 or self._cal_temp is None:
+            return None
+        # frequency x temperature surface, piecewise-linear in temperature
+        if self._range not in self._surfaces:
+            self._surfaces[self._range] = (
+                np.array([s["T"] for s in snapshots]),
+                np.array([s["gain"] for s in snapshots]),
+                np.array([s["phase"] for s in snapshots]),
+            )
+        temps = self._surfaces[self._range][0]
+        i = min(max(int(np.searchsorted(temps, self._cal_temp)), 1), len(temps) - 1)
+        # clamp to the calibrated temperature range instead of extrapolating
+        w = min(max((self._cal_temp - temps[i - 1]) / (temps[i] - temps[i - 1]), 0), 1)
+        return i, w
+
+    def _cal_parameters(self):
+        blend = self._blend()
+        if blend is None:
+            return self.gain_parameters[self._range], self.phase_offsets[self._range]
+        i, w = blend
+        _, gain, phase = self._surfaces[self._range]
+        return (
+            list((1 - w) * gain[i - 1] + w * gain[i]),
+            list((1 - w) * phase[i - 1] + w * phase[i]),
         )
-        return spline(frequency)
+
+    def _interpolant(self, freqs, values):
+        return INTERPOLATORS[self.interpolation](freqs, values, self.smooth)
+
+    def _fitted(self, name):
+        # one interpolant per temperature snapshot, refitted only for a new
+        # calibration or engine, the board temperature just moves the blend
+        key = (self.interpolation, self.smooth)
+        cached = self._interpolants.get((name, self._range))
+        if cached is None or cached[0] != key:
+            cached = (key, {})
+            self._interpolants[(name, self._range)] = cached
+        fits = cached[1]
+        blend = self._blend()
+        if blend is None:
+            return self._fit(fits, None, name)
+        i, w = blend
+        if w == 0:
+            return self._fit(fits, i - 1, name)
+        if w == 1:
+            return self._fit(fits, i, name)
+        low, high = self._fit(fits, i - 1, name), self._fit(fits, i, name)
+        return lambda f: (1 - w) * low(f) + w * high(f)
+
+    def _fit(self, fits, snapshot, name):
+        # snapshot index, None for the current calibration
+        if snapshot not in fits:
+            if snapshot is None:
+                freqs = self.cal_frequencies[self._range]
+                values = self._cal_parameters()[name == "phase"]
+            else:
+                freqs = self.cal_snapshots[self._range][snapshot]["freqs"]
+                values = self.cal_snapshots[self._range][snapshot][name]
+            fits[snapshot] = self._interpolant(freqs, values)
+        return fits[snapshot]
+
+    def _gain(self, frequency):
+        with metrics.span("ad5933.gain"):
+            return self._fitted("gain")(frequency)
+
+    def _phase(self, frequency):
+        with metrics.span("ad5933.phase"):
+            return self._fitted("phase")(frequency)
+
+    def use_clock(self, clock):
+        # switch MCLK and load the calibrations taken at that clock
+        self.clock_frequency = clock
+        for index in CAL_RANGES:
+            cal = self.calibrations.get((self.clock, index))
+            self.cal_frequencies[index] = cal["freqs"] if cal else []
+            self.gain_parameters[index] = cal["gain"] if cal else []
+            self.phase_offsets[index] = cal["phase"] if cal else []
+            self.cal_snapshots[index] = cal["snapshots"] if cal else []
+        self._surfaces.clear()
+        self._interpolants.clear()
+        self.drift = None
+
+    def export_calibrations(self):
+        return [
+            {"clock": clock, "range": index, **cal}
+            for (clock, index), cal in self.calibrations.items()
+        ]
+
+    def import_calibrations(self, calibrations):
+        for cal in calibrations:
+            self.calibrations[(cal["clock"], cal["range"])] = {
+                key: cal[key] for key in ("freqs", "gain", "phase", "snapshots")
+            }
+        self.use_clock(self.clock)
+
+    def uncalibrated_bands(self, freqs):
+        return [
+            clock
+            for clock, _ in plan_bands(freqs)
+            if (clock, self._range) not in self.calibrations
+        ]
+
+    def sweep_bands(self, freqs):
+        return list(self.iter_sweep_bands(freqs))
+
+    def iter_sweep_bands(self, freqs):
+        # wide-range sweep, every band runs at the fastest clock it allows
+        assert not self.uncalibrated_bands(freqs), "not all bands are calibrated"
+        previous = self.clock
+        try:
+            for clock, band in plan_bands(freqs):
+                self.use_clock(clock)
+                for run in linear_runs(band):
+                    increment = run[1] - run[0] if len(run) > 1 else 0
+                    yield from self.iter_sweep(run[0], increment, len(run) - 1)
+        finally:
+            self.use_clock(previous)
 
     def cal_all_ranges(self):
         previous_range = self.range
@@ -157,71 +626,194 @@ class AD5933:
             self.cal_range(i)
         self.range = previous_range
 
-    def measure(self, f=10000):
-        data = self._raw_sweep(f, 0, SAMPLES_PER_POINT)
+    def check_drift(self, f):
+        # measure the calibration resistor of the active range at f, later
+        # measurements at f are corrected by the change since calibration
+        index = self._range
+        with metrics.span("ad5933.drift_check"):
+            self._select_cal(index)
+            try:
+                self._update_temp()
+                gain, phase = self._cal_point(index, f)
+            finally:
+                self.range = index
+        offset = wrap_phase(phase - self._phase(f))
+        self.drift = (f, float(gain / self._gain(f)), float(offset))
+        metrics.count("drift.checks")
+        logger.debug(
+            f"drift at {f} Hz: gain {(self.drift[1] - 1) * 100:+.3f} %, "
+            f"phase {offset / pi * 180:+.3f}°"
+        )
+        return self.drift
+
+    def measure(self, f=10000, samples=None):
+        self._update_temp()
+        if samples is None:
+            samples = self.samples_per_point
+        data = self._raw_sweep(f, 0, samples)
         real = mean(data["real"])
         imag = mean(data["imag"])
         magnitude = sqrt(real ** 2 + imag ** 2)
         phase = atan2(imag, real)
+        gain, offset = self._gain(f), self._phase(f)
+        if self.drift is not None and self.drift[0] == f:
+            gain *= self.drift[1]
+            offset += self.drift[2]
         return (
-            1 / self._gain(f) / magnitude,
-            (phase - self._phase(f)) / pi * 180,
+            1 / gain / magnitude,
+            (phase - offset) / pi * 180,
         )
 
     def sweep(self, start, increment, points):
-        output = []
-        data = self._raw_sweep(start, increment, points)
-        for i, (real, imag) in enumerate(zip(data["real"], data["imag"])):
-            magnitude = sqrt(real ** 2 + imag ** 2)
-            phase = atan2(imag, real)
+        return list(self.iter_sweep(start, increment, points))
+
+    def iter_sweep(self, start, increment, points):
+        # yields calibrated points as the hardware produces them
+        self._update_temp()
+        raw = self._iter_raw_sweep(start, increment, points)
+        for i, (real, imag) in enumerate(raw):
             f = start + increment * i
-            magnitude = 1 / self._gain(f) / magnitude
-            phase_deg = (phase - self._phase(f)) / pi * 180
-            output.append({"f": f, "magnitude": magnitude, "phase": phase_deg})
-        return output
+            magnitude = 1 / self._gain(f) / sqrt(real ** 2 + imag ** 2)
+            phase_deg = (atan2(imag, real) - self._phase(f)) / pi * 180
+            yield {"f": f, "magnitude": magnitude, "phase": phase_deg}
+
+    def sweep_repeated(self, start, increment, points, repeats, target=None):
+        # generator of running mean/variance, see stats.average_sweeps()
+        return average_sweeps(
+            lambda: self.sweep(start, increment, points), repeats, target
+        )
 
-    def _raw_sweep(self, start, increment, points):
+    def acquire_sweep(self, start, increment, points):
+        # hardware half of sweep(), see pipeline.py
+        temp = self.temp if self.temp_compensation else None
+        return temp, self._raw_sweep(start, increment, points)
+
+    def process_sweep(self, start, increment, acquired):
+        # calibrates a sweep from acquire_sweep(), vectorized over the points
+        temp, data = acquired
+        if temp is not None:
+            self._update_temp(temp)
+        real = np.array(data["real"], dtype=float)
+        imag = np.array(data["imag"], dtype=float)
+        f = start + increment * np.arange(len(real))
+        magnitude = 1 / np.asarray(self._gain(f)) / np.hypot(real, imag)
+        phase = (np.arctan2(imag, real) - np.asarray(self._phase(f))) / pi * 180
+        return [
+            {"f": f_, "magnitude": m, "phase": p}
+            for f_, m, p in zip(f.tolist(), magnitude.tolist(), phase.tolist())
+        ]
+
+    def _program(self, start, increment, points):
         # number of increments is limited to 9 bits
         if points not in range(512):
             logging.warning(
                 f"clamping points to allowed range: {points} -> {(points:=min(points,511))}"
             )
-        self.output.attrs["frequency_start"].value = f"{start:.0f}"
-        self.output.attrs["frequency_increment"].value = f"{increment:.0f}"
-        self.output.attrs["frequency_points"].value = f"{points:.0f}"
-        self.output.attrs["settling_cycles"].value = "10"
+        with metrics.span("ad5933.attrs"):
+            attrs = self.output.attrs
+            self._write_attr(attrs["frequency_start"], f"{start:.0f}")
+            self._write_attr(attrs["frequency_increment"], f"{increment:.0f}")
+            self._write_attr(attrs["frequency_points"], f"{points:.0f}")
+            self._write_attr(attrs["settling_cycles"], f"{self.settling_cycles:.0f}")
 
         self.real.enabled = True
         self.imag.enabled = True
-        buf = iio.Buffer(self.dev, (points + 1))
+        return points
+
+    def _refill(self, buf, cancelled=None):
+        with metrics.span("ad5933.refill"):
+            try:
+                buf.refill()
+            except OSError as e:
+                if cancelled is not None and cancelled.is_set():
+                    raise
+                if e.errno == errno.ETIMEDOUT:
+                    metrics.count("iio.timeouts")
+                metrics.count("iio.refill_errors")
+                raise
+
+    def _decode(self, buf):
+        with metrics.span("ad5933.decode"):
+            real_data = tuple(
+                data[0] for data in struct.iter_unpack("<h", self.real.read(buf))
+            )
+            imag_data = tuple(
+                data[0] for data in struct.iter_unpack("<h", self.imag.read(buf))
+            )
+        return real_data, imag_data
+
+    def _raw_sweep(self, start, increment, points):
+        points = self._program(start, increment, points)
+        self.dev.set_kernel_buffers_count(KERNEL_BUFFERS)
+        buf = self.backend.Buffer(self.dev, (points + 1))
         assert buf is not None
-        buf.refill()
+        self._refill(buf)
 
         logger.debug(f"buf: 0x{buf.read().hex()})")
-        real_data = tuple(
-            data[0] for data in struct.iter_unpack("<h", self.real.read(buf))
-        )
-        imag_data = tuple(
-            data[0] for data in struct.iter_unpack("<h", self.imag.read(buf))
-        )
+        real_data, imag_data = self._decode(buf)
 
         buf.cancel()
         return {"real": real_data, "imag": imag_data}
 
+    def _iter_raw_sweep(self, start, increment, points):
+        # enabling the buffer starts the sweep in the driver, which pushes
+        # one sample per frequency and drops them when the kernel FIFO is
+        # full, so the FIFO holds the whole sweep and a reader thread drains
+        # it one refill per sample
+        points = self._program(start, increment, points)
+        self.dev.set_kernel_buffers_count(points + 1)
+        buf = self.backend.Buffer(self.dev, 1)
+        assert buf is not None
+        samples = Queue()
+        cancelled = Event()
+
+        def read():
+            try:
+                for _ in range(points + 1):
+                    self._refill(buf, cancelled)
+                    samples.put(self._decode(buf))
+            except OSError as e:
+                samples.put(e)
+
+        reader = Thread(target=read, name="ad5933-reader", daemon=True)
+        reader.start()
+        try:
+            for _ in range(points + 1):
+                sample = samples.get()
+                if isinstance(sample, Exception):
+                    raise sample
+                real_data, imag_data = sample
+                yield real_data[0], imag_data[0]
+        finally:
+            # also powers down the AD5933 if the consumer stops early
+            cancelled.set()
+            buf.cancel()
+            reader.join()
+
     def _set_gain(self, factor):
         assert factor in (1, 5), "only gains of x1 and x5 are available"
-        self.input.attrs["scale"].value = "1" if factor == 1 else "0.2"
+        self._write_attr(self.input.attrs["scale"], "1" if factor == 1 else "0.2")
 
     def _set_output_voltage(self, index):
         assert index in range(
             1, len(OUTPUT_VOLTAGES)
         ), f"index needs to be a number between 1 and {len(OUTPUT_VOLTAGES)}"
-        self.output.attrs["raw"].value = OUTPUT_VOLTAGES[index - 1]
+        self._write_attr(self.output.attrs["raw"], OUTPUT_VOLTAGES[index - 1])
+
+    def _write_attr(self, attr, value):
+        # the driver keeps its register state, so unchanged values are skipped
+        if self._attr_values.get(attr) == value:
+            self.bus.skip(self.name)
+            return
+        # attribute writes end up as I2C transfers in the kernel driver;
+        # buffer refills are not serialized as they can take minutes
+        self._attr_values.pop(attr, None)
+        self.bus.transaction(self.name, setattr, attr, "value", value)
+        self._attr_values[attr] = value
 
 
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
-    import numpy as np
 
     @np.vectorize
     def Z(f, R, C):
@@ -274,7 +866,7 @@ if __name__ == "__main__":
 
     def check_gain(impedance):
         plt.plot(
-            impedance.cal_freqs,
+            impedance.cal_frequencies[impedance.range],
             impedance.gain_parameters[impedance.range],
             label="measured",
         )
@@ -284,7 +876,7 @@ if __name__ == "__main__":
 
     def check_phase(impedance):
         plt.plot(
-            impedance.cal_freqs,
+            impedance.cal_frequencies[impedance.range],
             impedance.phase_offsets[impedance.range],
             label="measured",
         )
@@ -4,20 +4,25 @@
 
 from time import sleep
 
-from smbus import SMBus
+from i2c import RASPI_BUS, I2CBus
 
 ADG729_ADDR = 0x44
-# equivalent to /dev/i2c-1
-RASPI_BUS = 1
 
 
 class ADG729:
     def __init__(self, bus=RASPI_BUS, addr=ADG729_ADDR):
-        self.bus = SMBus(bus)
+        self.bus = I2CBus.get(bus)
         self.addr = addr
+        self.name = f"adg729@{addr:#04x}"
+        # last known switch state, None forces a read-back
+        self._state = None
+
+    def _read_byte(self):
+        return self.bus.smbus.read_byte(self.addr)
 
     def _read(self):
-        data = self.bus.read_byte(self.addr)
+        data = self.bus.transaction(self.name, self._read_byte)
+        self._state = data
         # little-endian format
         return [bool(data & (1 << i)) for i in range(8)]
 
@@ -38,7 +43,12 @@ class ADG729:
         assert a is None or a in range(5)
         assert b is None or b in range(5)
 
-        data = self.bus.read_byte(self.addr)
+        if self.bus.transaction(self.name, self._write, a, b):
+            sleep(0.01)
+
+    def _write(self, a, b):
+        # runs under the bus lock, so read-modify-write is atomic
+        data = self._state if self._state is not None else self._read_byte()
 
         if a is not None:
             if a > 0:
@@ -54,8 +64,16 @@ class ADG729:
             else:
                 data = data & 0x0F
 
-        self.bus.write_byte(self.addr, data)
-        sleep(0.01)
+        if data == self._state:
+            self.bus.skip(self.name)
+            return False
+        try:
+            self.bus.smbus.write_byte(self.addr, data)
+        except OSError:
+            self._state = None
+            raise
+        self._state = data
+        return True
 
 
 if __name__ == "__main__":
@@ -0,0 +1,151 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+# Several sensor boards, each an AD5933 with its own ADG729 mux and MCP9600
+# thermocouple amplifier on a separate I2C bus. Boards are listed in
+# BOARDS_FILE like
+#
+# [
+#     {"device": "iio:device0"},
+#     {"device": "iio:device1", "mux": 69, "thermo": null}
+# ]
+#
+# and otherwise enumerated from IIO with default addresses.
+
+import json
+import logging
+import os
+from threading import Event, Thread
+from time import monotonic
+
+try:
+    import iio
+except ImportError:
+    # boards can't be enumerated, AD5933 reports the missing libiio
+    iio = None
+
+import metrics
+from ad5933 import AD5933, find_devices
+from adg729 import ADG729_ADDR
+from mcp9600 import MCP9600, MCP9600_ADDR
+from sampler import TemperatureSampler
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+BOARDS_FILE = os.path.expanduser("~/.config/impedance/boards.json")
+TCOUPLE_FILTER = 2
+
+
+def find_boards(filename=BOARDS_FILE):
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        pass
+    if iio is None:
+        return []
+    devices = find_devices(iio.Context())
+    # the first board keeps the single-board defaults
+    return [{"device": device if i else None} for i, device in enumerate(devices)]
+
+
+class Board:
+    def __init__(
+        self,
+        device=None,
+        mux=ADG729_ADDR,
+        thermo=MCP9600_ADDR,
+        filter_level=TCOUPLE_FILTER,
+        backend=iio,
+    ):
+        self.impedance = AD5933(device=device, mux_addr=mux, backend=backend)
+        self.impedance.load_cal_grids()
+        self.name = self.impedance.dev.id
+        if thermo is None:
+            self.thermo = None
+        else:
+            self.thermo = TemperatureSampler(
+                MCP9600(self.impedance.bus.bus, thermo), filter_level=filter_level
+            )
+
+    def start(self):
+        if self.thermo is not None:
+            self.thermo.start()
+
+    def stop(self):
+        if self.thermo is not None:
+            self.thermo.stop()
+
+    def temp_at(self, t):
+        return float("nan") if self.thermo is None else self.thermo.at(t)
+
+
+class BoardWorker(Thread):
+    # continuous acquisition of one board into a shared data logger
+    def __init__(self, board, data_logger, f, interval, range_=None, drift=None):
+        super().__init__(name=f"board-{board.name}", daemon=True)
+        self.board = board
+        self.data_logger = data_logger
+        self.f = f
+        self.interval = interval
+        self.range = range_
+        # trigger.DriftSchedule for reference checks, None to skip them
+        self.drift = drift
+        self._stop = Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        impedance = self.board.impedance
+        try:
+            if self.range is not None:
+                impedance.range = self.range
+            if not impedance.gain_parameters[impedance.range]:
+                logger.info(f"{self.board.name}: calibrating range {impedance.range}")
+                impedance.cal_range(impedance.range)
+            series = self.data_logger.start_continuous()
+            t0 = t_next = monotonic()
+            while not self._stop.is_set():
+                extra = {}
+                if self.drift is not None:
+                    extra["drift"] = self._check_drift(impedance)
+                t_start = monotonic()
+                with metrics.span(f"{self.name}.acquire"):
+                    magnitude, phase = impedance.measure(self.f)
+                t = (t_start + monotonic()) / 2
+                series = self.data_logger.append_continuous_point(
+                    {
+                        "f": self.f,
+                        "t": round(t - t0, 3),
+                        "magnitude": magnitude,
+                        "phase": phase,
+                        "T": self.board.temp_at(t),
+                        "device": self.board.name,
+                        **extra,
+                    },
+                    series,
+                )
+                t_next += self.interval
+                if t_next < monotonic():
+                    metrics.count("continuous.missed_ticks")
+                    t_next = monotonic()
+                self._stop.wait(t_next - monotonic())
+        except Exception:
+            logger.exception(f"{self.board.name}: acquisition failed")
+
+    def _check_drift(self, impedance):
+        # gain drift in percent when the reference was measured, else None
+        T = impedance.temp
+        if not self.drift.due(monotonic(), T):
+            return None
+        _, ratio, _ = impedance.check_drift(self.f)
+        self.drift.record(monotonic(), T)
+        return (ratio - 1) * 100
+
+
+if __name__ == "__main__":
+    for board in find_boards():
+        print(board)
@@ -0,0 +1,166 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+# Accuracy vs. speed of acquisition settings. Every combination of the
+# settings in GRID is calibrated and measured against reference DUTs, on the
+# simulated board by default or on the real one with a known DUT connected:
+#
+# python explore.py [--hardware R,C] [--spec 1.0,0.5] [--csv results.csv]
+#
+# Settings on the Pareto front of time and |Z| and phase error are marked,
+# --spec picks the fastest one within |Z| error (%) and phase error (°).
+
+import argparse
+import cmath
+import csv
+import itertools
+import logging
+import math
+from statistics import mean
+from time import perf_counter
+
+from ad5933 import CAL_FREQS, AD5933, log_spaced
+from simulator import SimulatedBoard, parallel_rc
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+GRID = {
+    "samples_per_point": (0, 2, 5),
+    "settling_cycles": (2, 10, 50),
+    "smooth": (0, 30),
+    "interpolation": ("spline", "pchip"),
+    # use every n-th of CAL_FREQS
+    "cal_step": (1, 2, 4),
+    "clock": (9000000, 2250000),
+}
+# R and parallel C, all within range 2
+REFERENCES = ((1000, 0), (3300, 0), (1000, 2.7e-9), (470, 10e-9))
+RANGE = 2
+# inside the limits of every clock in GRID
+TEST_FREQS = log_spaced(1000, 60000, 30)
+OBJECTIVES = ("time", "magnitude_error", "phase_error")
+
+
+def grid(axes=GRID):
+    combinations = []
+    for values in itertools.product(*axes.values()):
+        settings = dict(zip(axes, values))
+        # only the spline engine smoothes, the others run with the first value
+        spline = settings["interpolation"] == "spline"
+        if not spline and settings["smooth"] != axes["smooth"][0]:
+            continue
+        combinations.append(settings)
+    return combinations
+
+
+def errors(impedance, dut, freqs):
+    magnitude, phase = [], []
+    for f in freqs:
+        m, p = impedance.measure(f)
+        Z = dut(f)
+        magnitude.append(abs(m - abs(Z)) / abs(Z) * 100)
+        phase.append(abs(p - math.degrees(cmath.phase(Z))))
+    return float(mean(magnitude)), float(mean(phase))
+
+
+def evaluate(settings, references=REFERENCES, hardware=False, freqs=TEST_FREQS):
+    if hardware:
+        board = None
+        impedance = AD5933(cal_freqs=CAL_FREQS[:: settings["cal_step"]])
+        elapsed = perf_counter
+    else:
+        board = SimulatedBoard()
+        board.install()
+        impedance = AD5933(cal_freqs=CAL_FREQS[:: settings["cal_step"]], backend=board)
+
+        def elapsed():
+            return board.elapsed
+
+    impedance.samples_per_point = settings["samples_per_point"]
+    impedance.settling_cycles = settings["settling_cycles"]
+    impedance.smooth = settings["smooth"]
+    impedance.interpolation = settings["interpolation"]
+    impedance.clock_frequency = settings["clock"]
+    impedance.range = RANGE
+    t_start = elapsed()
+    impedance.cal_range(RANGE)
+    cal_time = elapsed() - t_start
+    results = []
+    for R, C in references:
+        if board is not None:
+            board.dut = parallel_rc(R, C)
+        t_start = elapsed()
+        magnitude, phase = errors(impedance, parallel_rc(R, C), freqs)
+        results.append((elapsed() - t_start, magnitude, phase))
+    return {
+        **settings,
+        "cal_time": cal_time,
+        "time": mean(r[0] for r in results),
+        "magnitude_error": mean(r[1] for r in results),
+        "phase_error": mean(r[2] for r in results),
+    }
+
+
+def pareto(results, objectives=OBJECTIVES):
+    # results no other result beats in every objective
+    def dominates(a, b):
+        return all(a[k] <= b[k] for k in objectives) and any(
+            a[k] < b[k] for k in objectives
+        )
+
+    return [r for r in results if not any(dominates(o, r) for o in results)]
+
+
+def fastest(results, magnitude_error, phase_error):
+    within = [
+        r
+        for r in results
+        if r["magnitude_error"] <= magnitude_error and r["phase_error"] <= phase_error
+    ]
+    return min(within, key=lambda r: r["time"], default=None)
+
+
+def render(results, front):
+    lines = [
+        f"  {'samples':>7} {'settling':>8} {'smooth':>6} {'interp':>7} {'cal_step':>8} "
+        f"{'clock':>8} {'cal (s)':>8} {'time (s)':>8} {'|Z| (%)':>8} {'phi (°)':>8}"
+    ]
+    for r in sorted(results, key=lambda r: r["time"]):
+        lines.append(
+            f"{'*' if r in front else ' '} {r['samples_per_point']:>7} "
+            f"{r['settling_cycles']:>8} {r['smooth']:>6} {r['interpolation']:>7} "
+            f"{r['cal_step']:>8} "
+            f"{r['clock']:>8} {r['cal_time']:>8.2f} {r['time']:>8.2f} "
+            f"{r['magnitude_error']:>8.3f} {r['phase_error']:>8.3f}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hardware", help="R,C of the DUT on the real board")
+    parser.add_argument("--spec", help="max. |Z| error in %% and phase error in °")
+    parser.add_argument("--csv", help="write all results to this file")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    references = REFERENCES
+    if args.hardware:
+        references = [tuple(float(v) for v in args.hardware.split(","))]
+    results = []
+    combinations = grid()
+    for i, settings in enumerate(combinations):
+        logger.info(f"{i + 1}/{len(combinations)}: {settings}")
+        results.append(evaluate(settings, references, bool(args.hardware)))
+    front = pareto(results)
+    print(render(results, front))
+    if args.spec:
+        best = fastest(results, *(float(v) for v in args.spec.split(",")))
+        print(f"\nfastest within spec: {best}")
+    if args.csv:
+        with open(args.csv, "w") as fh:
+            writer = csv.DictWriter(fh, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
@@ -6,65 +6,256 @@ import csv
 import io
 import logging
 import os
+import sys
+from bisect import bisect_right
+from itertools import accumulate
+from math import isnan, nan
+from threading import RLock
+
+import metrics
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
 SWEEP = 0
 CONTINUOUS = 1
+SWEEP_FIELDS = ("index", "f", "magnitude", "phase")
+CONTINUOUS_FIELDS = ("index", "f", "t", "magnitude", "phase", "T")
+# bucket widths of the continuous rollups in s, finest first
+ROLLUP_RESOLUTIONS = (10, 60, 3600)
+ROLLUP_VALUES = ("magnitude", "phase", "T")
+ROLLUP_FIELDS = ("index", "f", "t", "count") + tuple(
+    f"{name}_{stat}" for name in ROLLUP_VALUES for stat in ("mean", "min", "max")
+)
+
+
+class Rollup:
+    # min/max/mean over fixed time buckets, updated as samples arrive
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.buckets = []
+        self._counts = {}
+
+    def add(self, point):
+        t = point["t"] - point["t"] % self.resolution
+        if not self.buckets or self.buckets[-1]["t"] != t:
+            bucket = dict.fromkeys(ROLLUP_FIELDS, nan)
+            bucket.update(index=point["index"], f=point["f"], t=t, count=0)
+            if "device" in point:
+                bucket["device"] = point["device"]
+            self.buckets.append(bucket)
+            self._counts = dict.fromkeys(ROLLUP_VALUES, 0)
+        bucket = self.buckets[-1]
+        bucket["count"] += 1
+        for name in ROLLUP_VALUES:
+            value = point[name]
+            # temperature is NaN while the thermocouple is stale
+            if isnan(value):
+                continue
+            self._counts[name] += 1
+            n = self._counts[name]
+            mean, low, high = (f"{name}_{stat}" for stat in ("mean", "min", "max"))
+            if n == 1:
+                bucket[mean] = bucket[low] = bucket[high] = value
+            else:
+                bucket[mean] += (value - bucket[mean]) / n
+                bucket[low] = min(bucket[low], value)
+                bucket[high] = max(bucket[high], value)
 
 
 class DataLogger:
-    def __init__(self):
+    def __init__(self, journal=None):
+        # continuous samples are also written ahead to the journal
+        self.journal = journal
         self.index = 0
         self.data = []
+        self.points = 0
         self.mode = None
+        # one list of rollups per continuous series
+        self.rollups = []
+        # continuous series of several boards are appended concurrently
+        self.lock = RLock()
+        self._starts = (0, [])
 
     def clear(self):
-        self.index = 0
-        self.data.clear()
+        with self.lock:
+            self.index = 0
+            self.points = 0
+            self.data.clear()
+            self.rollups.clear()
+            self._starts = (0, [])
+            if self.journal is not None:
+                self.journal.reset()
+
+    def memory_usage(self):
+        # estimated from one point, they all share the same layout
+        sample = next((series[0] for series in self.data if series), None)
+        if sample is None:
+            return sys.getsizeof(self.data)
+        point = sys.getsizeof(sample) + sum(sys.getsizeof(v) for v in sample.values())
+        return (
+            self.points * point
+            + sys.getsizeof(self.data)
+            + sum(sys.getsizeof(series) for series in self.data)
+        )
 
     def append_sweep(self, sweep_data):
         if self.mode != SWEEP:
             logger.debug("switching modes - clearing data logger")
             self.clear()
             self.mode = SWEEP
-        for point in sweep_data:
-            point["index"] = self.index
-        self.data.append(sweep_data)
-        self.index += 1
+        with metrics.span("logger.append_sweep"):
+            for point in sweep_data:
+                point["index"] = self.index
+            self.data.append(sweep_data)
+            self.points += len(sweep_data)
+            self.index += 1
+
+    def start_continuous(self):
+        # returns the new series for append_continuous_point
+        with self.lock:
+            if self.mode != CONTINUOUS:
+                logger.debug("switching modes - clearing data logger")
+                self.clear()
+                self.mode = CONTINUOUS
+            self.data.append([])
+            self.rollups.append([Rollup(r) for r in ROLLUP_RESOLUTIONS])
+            self.index += 1
+            return self.index - 1
+
+    def append_continuous_point(self, point, series=-1):
+        # returns the series, a new one if the logger was cleared meanwhile
+        with self.lock:
+            if series < 0:
+                series += len(self.data)
+            if not 0 <= series < len(self.data):
+                series = self.start_continuous()
+            with metrics.span("logger.append_continuous"):
+                point["index"] = series
+                self.data[series].append(point)
+                for rollup in self.rollups[series]:
+                    rollup.add(point)
+                self.points += 1
+                if self.journal is not None:
+                    self.journal.append(point)
+        return series
+
+    def recover(self):
+        # reload the samples of an interrupted run from the journal
+        if self.journal is None:
+            return 0
+        points, complete = self.journal.read()
+        if complete:
+            self.journal.reset()
+            return 0
+        with self.lock:
+            journal, self.journal = self.journal, None
+            try:
+                series = {}
+                for point in points:
+                    if point["index"] not in series:
+                        series[point["index"]] = self.start_continuous()
+                    self.append_continuous_point(point, series[point["index"]])
+            finally:
+                self.journal = journal
+            # drop a torn tail and the numbering of the old session
+            journal.reset()
+            for data in self.data:
+                for point in data:
+                    journal.append(point)
+        return len(points)
+
+    def sync(self):
+        if self.journal is not None:
+            self.journal.sync()
+
+    def complete(self):
+        # the run stopped cleanly, nothing to recover
+        if self.journal is not None:
+            self.journal.complete()
 
     def append_continuous(self, continuous_data):
-        if self.mode != CONTINUOUS:
-            logger.debug("switching modes - clearing data logger")
-            self.clear()
-            self.mode = CONTINUOUS
+        self.start_continuous()
         for point in continuous_data:
-            point["index"] = self.index
-        self.data.append(continuous_data)
-        self.index += 1
+            self.append_continuous_point(point)
+
+    def rollup(self, resolution, series=-1):
+        # coarsest level that still resolves resolution, None for raw data
+        levels = [r for r in self.rollups[series] if r.resolution <= resolution]
+        return levels[-1] if levels else None
+
+    def overview(self, name, pixels, series=-1):
+        # t, mean, min and max of a value at roughly one point per pixel
+        data = self.data[series]
+        if not data:
+            return [], [], [], []
+        rollup = self.rollup((data[-1]["t"] - data[0]["t"]) / pixels, series)
+        if rollup is None:
+            values = [point[name] for point in data]
+            return [point["t"] for point in data], values, values, values
+        buckets = rollup.buckets
+        return (
+            [bucket["t"] + rollup.resolution / 2 for bucket in buckets],
+            [bucket[f"{name}_mean"] for bucket in buckets],
+            [bucket[f"{name}_min"] for bucket in buckets],
+            [bucket[f"{name}_max"] for bucket in buckets],
+        )
 
     def export_to_file(self, filename):
-        with open(filename, "w") as fh:
+        with metrics.span("logger.export_file"), open(filename, "w") as fh:
             self._csv(fh)
             os.fsync(fh.fileno())
 
+    def export_summary(self, filename, resolution):
+        assert self.mode == CONTINUOUS
+        with metrics.span("logger.export_summary"), open(filename, "w") as fh:
+            writer = csv.DictWriter(fh, fieldnames=self._fields(ROLLUP_FIELDS))
+            writer.writeheader()
+            for series in range(len(self.data)):
+                rollup = self.rollup(resolution, series) or self.rollups[series][0]
+                writer.writerows(rollup.buckets)
+            os.fsync(fh.fileno())
+
     def export_to_string(self):
-        with io.StringIO() as buf:
+        with metrics.span("logger.export_string"), io.StringIO() as buf:
             self._csv(buf)
             # limit to first 10000 values for performance reasons
             text = buf.getvalue()[:10000]
 
         return text
 
-    def _csv(self, fh):
+    def fields(self):
         if self.mode == SWEEP:
-            fields = ("index", "f", "magnitude", "phase")
+            fields = SWEEP_FIELDS
+            # averaged sweeps carry their spread
+            if any(series and "sweeps" in series[0] for series in self.data):
+                fields += ("magnitude_std", "phase_std", "sweeps")
+            return fields
         elif self.mode == CONTINUOUS:
-            fields = ("index", "f", "t", "magnitude", "phase", "T")
+            return self._fields(CONTINUOUS_FIELDS)
+        return ()
+
+    def row(self, i):
+        # i-th point across all series, series offsets are cached per size
+        if self._starts[0] != self.points:
+            self._starts = (self.points, list(accumulate(map(len, self.data))))
+        ends = self._starts[1]
+        series = bisect_right(ends, i)
+        return self.data[series][i - (ends[series - 1] if series else 0)]
+
+    def _csv(self, fh):
+        fields = self.fields()
         if self.data:
             writer = csv.DictWriter(fh, fieldnames=fields)
             writer.writeheader()
             for series in self.data:
                 for point in series:
                     writer.writerow(point)
+
+    def _fields(self, fields):
+        # samples of several boards are tagged with their device, runs with
+        # drift checks flag the sample after each check with the gain drift
+        for field in ("device", "drift"):
+            if any(series and field in series[0] for series in self.data):
+                fields += (field,)
+        return fields
@@ -0,0 +1,152 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+import html
+import logging
+import subprocess
+import threading
+from textwrap import dedent
+from time import monotonic, strftime
+
+import metrics
+from i2c import I2CBus
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# shell commands are slow, instrument counters are cheap
+HEALTH_INTERVAL = 30
+COUNTER_INTERVAL = 2
+SYSTEM_COMMAND = dedent(
+    r"""\
+    show(){
+        local _NAME="$*"
+        echo "$_NAME"
+        for _ in $(seq "${#_NAME}"); do
+           printf '%s' =
+        done
+        printf '\n'
+        eval "$@"
+        printf '\n'
+    }
+    commands(){
+        show systemctl status impedance
+        show uptime
+        show ip address show dev wlan0
+        show /sbin/iwconfig wlan0
+        show journalctl -b -n 10 -p warning
+    }
+    if command -v aha >/dev/null; then
+        SYSTEMD_COLORS=1 commands | aha -n -x | sed 'a <br/>'
+    else
+        commands
+    fi
+    """
+)
+
+
+def rss():
+    # resident set size of this process in bytes
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * 4096
+    except OSError:
+        return None
+
+
+class HealthCollector:
+    def __init__(self, data_logger=None, thermos=(), interval=HEALTH_INTERVAL):
+        self.data_logger = data_logger
+        self.thermos = [thermo for thermo in thermos if thermo is not None]
+        self.interval = interval
+        self.html = "<i>collecting system status ...</i>"
+        self.generation = 0
+        self.collected = None
+        self._refresh = False
+        self._system = ""
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="health", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+
+    def request(self):
+        # refresh now unless the snapshot is fresh anyway
+        if self.collected is None or monotonic() - self.collected > self.interval / 2:
+            self._refresh = True
+        self._wake.set()
+
+    def counters(self):
+        i2c_errors = sum(sum(bus.errors.values()) for bus in I2CBus.instances())
+        count = metrics.counters.get
+        counters = {
+            "IIO buffer timeouts": count("iio.timeouts", 0),
+            "IIO buffer errors": count("iio.refill_errors", 0),
+            "I2C errors": i2c_errors,
+            "missed continuous ticks": count("continuous.missed_ticks", 0),
+            "trigger probes": count("trigger.probes", 0),
+            "drift checks": count("drift.checks", 0),
+            "pipeline stalls": count("pipeline.stalls", 0),
+            "thermocouple errors": sum(thermo.errors for thermo in self.thermos),
+            "RSS": _size(rss()),
+        }
+        if self.data_logger is not None:
+            counters["data logger points"] = self.data_logger.points
+            counters["data logger memory"] = _size(self.data_logger.memory_usage())
+        return counters
+
+    def collect(self):
+        out = subprocess.run(
+            ["nice", "-n", "10", "sh"],
+            capture_output=True,
+            text=True,
+            input=SYSTEM_COMMAND,
+        )
+        if out.stderr:
+            logger.debug(f"shell stderr: {out.stderr}")
+        self._system = out.stdout
+
+    def render(self):
+        counters = "\n".join(
+            f"{name + ':':<26}{value}" for name, value in self.counters().items()
+        )
+        text = (
+            f"Instrument ({strftime('%H:%M:%S')})\n"
+            f"{'=' * 21}\n{counters}\n\n{metrics.render()}"
+        )
+        return self._system + f"<pre>{html.escape(text)}</pre>"
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if (
+                    self._refresh
+                    or self.collected is None
+                    or monotonic() - self.collected > self.interval
+                ):
+                    self._refresh = False
+                    self.collect()
+                    self.collected = monotonic()
+                self.html = self.render()
+                self.generation += 1
+            except Exception as e:
+                logger.warning(f"collecting system health failed: {e}")
+            self._wake.wait(COUNTER_INTERVAL)
+            self._wake.clear()
+
+
+def _size(n):
+    if n is None:
+        return "-"
+    for unit in ("B", "KiB", "MiB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GiB"
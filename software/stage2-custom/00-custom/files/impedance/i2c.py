@@ -0,0 +1,132 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+import errno
+import logging
+from collections import defaultdict
+from threading import Lock, RLock
+from time import perf_counter, sleep
+
+try:
+    from smbus import SMBus
+except ImportError:
+    # only needed on the instrument, replay.py stands in elsewhere
+    SMBus = None
+
+import metrics
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# equivalent to /dev/i2c-1
+RASPI_BUS = 1
+RETRIES = 3
+# doubled after every failed attempt
+RETRY_DELAY = 0.005
+# bus errors worth retrying, anything else (e.g. a rejected attribute value)
+# fails the same way again
+TRANSIENT_ERRORS = {
+    errno.EIO,
+    errno.EREMOTEIO,
+    errno.ETIMEDOUT,
+    errno.EAGAIN,
+    errno.ENXIO,
+}
+
+
+class I2CBus:
+    # one manager per bus number, shared by all devices on it
+    _instances = {}
+    _instances_lock = Lock()
+
+    @classmethod
+    def get(cls, bus=RASPI_BUS):
+        with cls._instances_lock:
+            if bus not in cls._instances:
+                cls._instances[bus] = cls(bus)
+            return cls._instances[bus]
+
+    @classmethod
+    def instances(cls):
+        with cls._instances_lock:
+            return list(cls._instances.values())
+
+    def __init__(self, bus=RASPI_BUS):
+        self.bus = bus
+        self.lock = RLock()
+        self.latency = defaultdict(metrics.Histogram)
+        self.wait = defaultdict(metrics.Histogram)
+        self.errors = defaultdict(int)
+        self.retries = defaultdict(int)
+        self.skipped = defaultdict(int)
+        self._smbus = None
+        metrics.register(f"i2c-{bus}", self.stats, self.render)
+
+    @property
+    def smbus(self):
+        with self.lock:
+            if self._smbus is None:
+                self._smbus = SMBus(self.bus)
+            return self._smbus
+
+    @smbus.setter
+    def smbus(self, smbus):
+        # lets replay.py record or stand in for the bus
+        with self.lock:
+            self._smbus = smbus
+
+    def transaction(self, device, func, *args, retries=RETRIES):
+        # func should contain everything that has to happen atomically,
+        # e.g. a whole read-modify-write
+        delay = RETRY_DELAY
+        for attempt in range(retries + 1):
+            t_wait = perf_counter()
+            with self.lock:
+                t_start = perf_counter()
+                self.wait[device].record(t_start - t_wait)
+                try:
+                    result = func(*args)
+                except OSError as e:
+                    self.errors[device] += 1
+                    if attempt == retries or e.errno not in TRANSIENT_ERRORS:
+                        raise
+                    logger.debug(f"{device}: {e} - retrying in {delay * 1000:.0f} ms")
+                else:
+                    self.latency[device].record(perf_counter() - t_start)
+                    return result
+            self.retries[device] += 1
+            sleep(delay)
+            delay *= 2
+
+    def skip(self, device):
+        # transaction that was coalesced away
+        self.skipped[device] += 1
+
+    def stats(self):
+        return {
+            device: {
+                "latency": self.latency[device].summary(),
+                "wait": self.wait[device].summary(),
+                "errors": self.errors[device],
+                "retries": self.retries[device],
+                "skipped": self.skipped[device],
+            }
+            for device in sorted(set(self.latency) | set(self.errors))
+        }
+
+    @staticmethod
+    def render(stats):
+        lines = [
+            f"{'device':<16}{'count':>8}{'p50':>8}{'p90':>8}{'max':>8}"
+            f"{'wait90':>8}{'err':>6}{'retry':>6}{'skip':>6}"
+        ]
+        for device, s in stats.items():
+            latency = s["latency"]
+            lines.append(
+                f"{device:<16}{latency['count']:>8}{metrics.ms(latency['p50']):>8}"
+                f"{metrics.ms(latency['p90']):>8}{metrics.ms(latency['max']):>8}"
+                f"{metrics.ms(s['wait']['p90']):>8}{s['errors']:>6}"
+                f"{s['retries']:>6}{s['skipped']:>6}"
+            )
+        return lines
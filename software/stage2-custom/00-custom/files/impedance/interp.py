@@ -0,0 +1,147 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+# Interpolation of calibration gain and phase over frequency. Every engine
+# takes the calibration frequencies, values and smoothing factor and returns
+# a callable evaluated at one or more frequencies.
+#
+# python interp.py [calibrations.json]
+#
+# benchmarks fit and evaluation cost and the error at held-out calibration
+# points, on exported calibrations or a simulated board.
+
+import math
+from statistics import stdev
+from time import perf_counter
+
+import numpy as np
+from scipy.interpolate import PchipInterpolator, UnivariateSpline
+
+# log-spaced lookup table grid, ~0.04 % frequency resolution
+LUT_POINTS = 2 ** 15
+LUT_RANGE = (1, 100000)
+
+
+def spline(freqs, values, smooth=0):
+    return UnivariateSpline(
+        freqs,
+        values,
+        s=smooth,
+        k=3,
+        w=[2 / stdev(values)] * len(freqs),
+    )
+
+
+def pchip(freqs, values, smooth=0):
+    # shape-preserving, no overshoot between calibration points
+    return PchipInterpolator(freqs, values)
+
+
+def loglinear(freqs, values, smooth=0):
+    # held constant outside the calibrated range
+    x = np.log(freqs)
+    y = np.asarray(values, dtype=float)
+
+    def interpolate(f):
+        return np.interp(np.log(f), x, y)
+
+    return interpolate
+
+
+class LookupTable:
+    # dense table on a fixed grid, looked up by index instead of evaluated
+    def __init__(self, freqs, values, smooth=0, base=pchip, points=LUT_POINTS):
+        low, high = LUT_RANGE
+        self.offset = math.log(low)
+        self.scale = (points - 1) / (math.log(high) - math.log(low))
+        grid = np.geomspace(low, high, points)
+        self.table = np.asarray(base(freqs, values, smooth)(grid), dtype=float)
+        self._list = self.table.tolist()
+
+    def __call__(self, f):
+        if isinstance(f, (int, float)):
+            i = round((math.log(f) - self.offset) * self.scale)
+            return self._list[min(max(i, 0), len(self._list) - 1)]
+        i = np.rint((np.log(f) - self.offset) * self.scale).astype(int)
+        return self.table[np.clip(i, 0, len(self.table) - 1)]
+
+
+INTERPOLATORS = {
+    "spline": spline,
+    "pchip": pchip,
+    "loglinear": loglinear,
+    "lut": LookupTable,
+}
+
+
+def benchmark(freqs, values, smooth=0, repeats=1000):
+    # fit on every other point, the rest is held out
+    freqs = np.asarray(freqs, dtype=float)
+    values = np.asarray(values, dtype=float)
+    fit_f, fit_v = freqs[::2], values[::2]
+    test_f, test_v = freqs[1::2], values[1::2]
+    scale = np.max(np.abs(values))
+    results = {}
+    for name, engine in INTERPOLATORS.items():
+        t_start = perf_counter()
+        interpolant = engine(fit_f, fit_v, smooth)
+        fit = perf_counter() - t_start
+        t_start = perf_counter()
+        for i in range(repeats):
+            interpolant(test_f[i % len(test_f)])
+        scalar = (perf_counter() - t_start) / repeats
+        t_start = perf_counter()
+        interpolant(test_f)
+        vector = perf_counter() - t_start
+        error = np.abs(interpolant(test_f) - test_v) / scale
+        results[name] = {
+            "fit": fit,
+            "scalar": scalar,
+            "vector": vector,
+            "mean_error": float(np.mean(error)),
+            "max_error": float(np.max(error)),
+        }
+    return results
+
+
+def render(title, results):
+    lines = [
+        title,
+        f"{'engine':<10}{'fit':>10}{'per call':>10}{'vector':>10}"
+        f"{'mean err':>10}{'max err':>10}",
+    ]
+    for name, r in results.items():
+        lines.append(
+            f"{name:<10}{r['fit'] * 1e3:>8.3f}ms{r['scalar'] * 1e6:>8.1f}µs"
+            f"{r['vector'] * 1e6:>8.1f}µs"
+            f"{r['mean_error']:>10.2e}{r['max_error']:>10.2e}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import json
+    import sys
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as fh:
+            calibrations = json.load(fh)
+        # protocol checkpoints carry them along with the progress
+        if isinstance(calibrations, dict):
+            calibrations = calibrations["calibrations"]
+    else:
+        from ad5933 import AD5933
+        from simulator import SimulatedBoard
+
+        board = SimulatedBoard()
+        board.install()
+        impedance = AD5933(backend=board)
+        impedance.cal_range(2)
+        calibrations = impedance.export_calibrations()
+    for cal in calibrations:
+        title = f"clock {cal['clock']} Hz, range {cal['range']}"
+        for name in ("gain", "phase"):
+            results = benchmark(cal["freqs"], cal[name])
+            print(render(f"{title}, {name} ({len(cal['freqs'])} points)", results))
+            print()
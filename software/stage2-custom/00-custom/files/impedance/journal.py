@@ -0,0 +1,105 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+# Write-ahead journal of continuous samples, one JSON line per sample. Lines
+# are flushed right away, so a crash of the process loses nothing, and
+# fsynced in batches, so power loss costs at most SYNC_INTERVAL seconds. A
+# run that stops cleanly ends with the COMPLETE line, only a journal without
+# it is recovered.
+
+import json
+import logging
+import os
+from threading import Lock, Timer
+from time import monotonic
+
+import metrics
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = os.path.expanduser("~/.local/state/impedance/continuous.journal")
+SYNC_INTERVAL = 5
+COMPLETE = {"complete": True}
+
+
+class Journal:
+    def __init__(self, filename=JOURNAL_FILE, sync_interval=SYNC_INTERVAL):
+        self.filename = filename
+        self.sync_interval = sync_interval
+        self._lock = Lock()
+        self._timer = None
+        self._synced = monotonic()
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.fh = open(filename, "a")
+
+    def read(self):
+        # returns the samples and whether the last run was completed, a torn
+        # last line is what an interrupted write looks like
+        points = []
+        complete = False
+        with open(self.filename) as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning(f"ignoring torn journal entry: {line!r}")
+                    complete = False
+                    break
+                complete = entry == COMPLETE
+                if not complete:
+                    points.append(entry)
+        return points, complete
+
+    def append(self, point):
+        with self._lock:
+            # samples still arriving during shutdown
+            if self.fh.closed:
+                return
+            self.fh.write(json.dumps(point, separators=(",", ":")) + "\n")
+            self.fh.flush()
+            if monotonic() - self._synced >= self.sync_interval:
+                self._sync()
+            elif self._timer is None:
+                # bound the loss window even if no further samples come
+                self._timer = Timer(self.sync_interval, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def sync(self):
+        with self._lock:
+            if not self.fh.closed:
+                self._sync()
+
+    def reset(self):
+        with self._lock:
+            self.fh.truncate(0)
+            self.fh.seek(0)
+            self._sync()
+
+    def complete(self):
+        # samples appended later start a new incomplete run
+        with self._lock:
+            if not self.fh.closed:
+                self._complete()
+
+    def close(self, complete=False):
+        with self._lock:
+            if complete and not self.fh.closed:
+                self._complete()
+            self._sync()
+            self.fh.close()
+
+    def _complete(self):
+        self.fh.write(json.dumps(COMPLETE) + "\n")
+        self.fh.flush()
+        self._sync()
+
+    def _sync(self):
+        with metrics.span("journal.fsync"):
+            os.fsync(self.fh.fileno())
+        self._synced = monotonic()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
@@ -5,42 +5,51 @@
 import struct
 from fcntl import ioctl
 
-from smbus import SMBus
+from i2c import RASPI_BUS, I2CBus
 
 MCP9600_ADDR = 0x60
 HOT_JUNC_REG = 0x00
 # i2c-dev ioctl command for selecting slave address
 I2C_SLAVE = 0x0703
-# equivalent to /dev/i2c-1
-RASPI_BUS = 1
 
 
 class MCP9600:
-    def __init__(self, bus=RASPI_BUS, addr=MCP9600_ADDR):
-        self.fd = open(f"/dev/i2c-{RASPI_BUS}", "r+b", buffering=0)
-        ioctl(self.fd, I2C_SLAVE, addr)
+    def __init__(self, bus=RASPI_BUS, addr=MCP9600_ADDR, fd=None):
+        self.bus = I2CBus.get(bus)
+        self.name = f"mcp9600@{addr:#04x}"
+        if fd is None:
+            fd = open(f"/dev/i2c-{bus}", "r+b", buffering=0)
+            ioctl(fd, I2C_SLAVE, addr)
+        self.fd = fd
         # set register pointer to hot junction register
         # self.fd.write(b"\x00")
 
-    def enable_filter(self, level):
+    def _enable_filter(self, level):
         # set register pointer to sensor configuration sensor
         # and write filter value
         self.fd.write(b"\x05" + level.to_bytes(1, "big"))
         # set register pointer to hot junction register
         self.fd.write(b"\x00")
 
+    def enable_filter(self, level):
+        self.bus.transaction(self.name, self._enable_filter, level)
+
     @property
     def temp(self):
-        return struct.unpack(">h", self.fd.read(2))[0] / 16
+        data = self.bus.transaction(self.name, self.fd.read, 2)
+        return struct.unpack(">h", data)[0] / 16
 
 
 class _MCP9600:
     def __init__(self, bus=RASPI_BUS, addr=MCP9600_ADDR):
-        self.bus = SMBus(bus)
+        self.bus = I2CBus.get(bus)
+        self.name = f"mcp9600@{addr:#04x}"
         self.addr = addr
 
     def _read(self, reg, size):
-        return self.bus.read_i2c_block_data(self.addr, reg, size)
+        return self.bus.transaction(
+            self.name, self.bus.smbus.read_i2c_block_data, self.addr, reg, size
+        )
 
     @property
     def temp(self):
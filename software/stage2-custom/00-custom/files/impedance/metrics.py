@@ -0,0 +1,225 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+import json
+import os
+from bisect import bisect_left
+from collections import defaultdict, deque
+from threading import Lock
+from time import perf_counter
+
+# upper bucket edges in seconds: 10 µs ... ~42 min, doubling
+BUCKETS = tuple(1e-5 * 2 ** i for i in range(28))
+# number of recent spans the rolling percentiles are computed from
+WINDOW = 500
+METRICS_FILE = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "impedance-metrics.json"
+)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # last bucket catches everything beyond the largest edge
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.total = 0.0
+            self.min = None
+            self.max = None
+
+    def record(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        # upper edge of the bucket containing the p-th percentile
+        with self._lock:
+            if not self.count:
+                return None
+            rank = p / 100 * self.count
+            seen = 0
+            for i, n in enumerate(self.counts):
+                seen += n
+                if seen >= rank and n:
+                    if i == len(self.buckets):
+                        return self.max
+                    return min(self.buckets[i], self.max)
+            return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class RollingHistogram(Histogram):
+    def __init__(self, window=WINDOW, buckets=BUCKETS):
+        self.recent = deque(maxlen=window)
+        super().__init__(buckets)
+
+    def clear(self):
+        super().clear()
+        self.recent.clear()
+
+    def record(self, value):
+        super().record(value)
+        self.recent.append(value)
+
+    def summary(self):
+        summary = super().summary()
+        recent = sorted(self.recent)
+        if recent:
+            summary["recent"] = {
+                "count": len(recent),
+                "mean": sum(recent) / len(recent),
+                "p50": recent[len(recent) // 2],
+                "p90": recent[int(len(recent) * 0.9)],
+                "max": recent[-1],
+            }
+        return summary
+
+
+class _Span:
+    __slots__ = ("name", "t")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _histogram(self.name).record(perf_counter() - self.t)
+        return False
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+_enabled = os.environ.get("IMPEDANCE_TRACE", "0") != "0"
+spans = defaultdict(RollingHistogram)
+counters = defaultdict(int)
+# counters and new span names come from many threads
+_lock = Lock()
+# name -> (callable returning a JSON-serializable dict, text renderer or None)
+sources = {}
+
+
+def enable(flag=True):
+    global _enabled
+    _enabled = flag
+
+
+def enabled():
+    return _enabled
+
+
+def span(name):
+    # usage: with metrics.span("stage"): ...
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def _histogram(name):
+    histogram = spans.get(name)
+    if histogram is None:
+        with _lock:
+            histogram = spans[name]
+    return histogram
+
+
+def count(name, n=1):
+    # counters are always on, they are cheap and rarely hit
+    with _lock:
+        counters[name] += n
+
+
+def register(name, func, renderer=None):
+    sources[name] = (func, renderer)
+
+
+def reset():
+    with _lock:
+        histograms = list(spans.values())
+    for histogram in histograms:
+        histogram.clear()
+
+
+def snapshot():
+    with _lock:
+        histograms = sorted(spans.items())
+        counts = dict(sorted(counters.items()))
+    return {
+        "tracing": _enabled,
+        "spans": {name: histogram.summary() for name, histogram in histograms},
+        "counters": counts,
+        **{name: func() for name, (func, _) in sources.items()},
+    }
+
+
+def ms(value):
+    return "-" if value is None else f"{value * 1000:.2f}"
+
+
+def render(data=None):
+    data = snapshot() if data is None else data
+    lines = [f"tracing: {'on' if data['tracing'] else 'off'}", ""]
+    lines.append(
+        f"{'span':<24}{'count':>8}{'mean':>10}{'p50':>10}{'p90':>10}{'max':>10}"
+    )
+    for name, summary in data["spans"].items():
+        recent = summary.get("recent", summary)
+        lines.append(
+            f"{name:<24}{summary['count']:>8}{ms(recent['mean']):>10}"
+            f"{ms(recent['p50']):>10}{ms(recent['p90']):>10}{ms(recent['max']):>10}"
+        )
+    lines.append("(times in ms, percentiles over recent spans)")
+    if data["counters"]:
+        lines.append("")
+        lines.extend(f"{name}: {value}" for name, value in data["counters"].items())
+    for name, (_, renderer) in sources.items():
+        lines.append("")
+        if renderer is None:
+            lines.append(f"{name}: {json.dumps(data.get(name), indent=1)}")
+        else:
+            lines.append(f"{name}:")
+            lines.extend(renderer(data.get(name)))
+    return "\n".join(lines)
+
+
+def write(filename=METRICS_FILE):
+    data = snapshot()
+    # write atomically, readers may poll the file
+    for path, text in (
+        (filename, json.dumps(data, indent=1)),
+        (os.path.splitext(filename)[0] + ".txt", render(data)),
+    ):
+        with open(path + ".tmp", "w") as fh:
+            fh.write(text)
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,125 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+# Repeated sweeps with acquisition overlapped with processing: a thread keeps
+# the AD5933 sweeping into a bounded queue while the consumer calibrates,
+# averages and plots the previous sweep. A full queue holds the hardware
+# back instead of piling up sweeps.
+
+import logging
+from queue import Full, Queue
+from threading import Event, Thread
+from time import monotonic
+
+import metrics
+
+# sweeps acquired ahead of the consumer
+QUEUE_DEPTH = 2
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+
+class SweepPipeline:
+    def __init__(self, impedance, start, increment, points, depth=QUEUE_DEPTH):
+        self.impedance = impedance
+        self.start = start
+        self.increment = increment
+        self.points = points
+        self.depth = depth
+        # processed sweeps and the time the hardware spent acquiring them
+        self.sweeps = 0
+        self.busy = 0.0
+        self._t0 = None
+
+    @property
+    def elapsed(self):
+        return 0.0 if self._t0 is None else monotonic() - self._t0
+
+    @property
+    def throughput(self):
+        # sweeps per minute
+        elapsed = self.elapsed
+        return self.sweeps / elapsed * 60 if elapsed else 0.0
+
+    @property
+    def duty_cycle(self):
+        elapsed = self.elapsed
+        return min(self.busy / elapsed, 1.0) if elapsed else 0.0
+
+    def __iter__(self):
+        queue = Queue(self.depth)
+        stopped = Event()
+
+        def put(item):
+            # blocks while the consumer is depth sweeps behind
+            while not stopped.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Full:
+                    metrics.count("pipeline.stalls")
+
+        def acquire():
+            try:
+                while not stopped.is_set():
+                    t_start = monotonic()
+                    with metrics.span("pipeline.acquire"):
+                        acquired = self.impedance.acquire_sweep(
+                            self.start, self.increment, self.points
+                        )
+                    put((monotonic() - t_start, acquired))
+            except Exception as e:
+                # raised again in the consumer
+                put((0.0, e))
+
+        self._t0 = monotonic()
+        thread = Thread(target=acquire, name="sweep-pipeline", daemon=True)
+        thread.start()
+        try:
+            while True:
+                busy, acquired = queue.get()
+                if isinstance(acquired, Exception):
+                    raise acquired
+                self.busy += busy
+                with metrics.span("pipeline.process"):
+                    data = self.impedance.process_sweep(
+                        self.start, self.increment, acquired
+                    )
+                self.sweeps += 1
+                yield data
+        finally:
+            # the sweep in flight is finished, not cancelled
+            stopped.set()
+            thread.join()
+            logger.debug(
+                f"pipeline: {self.sweeps} sweeps, {self.throughput:.1f} sweeps/min, "
+                f"duty cycle {self.duty_cycle * 100:.0f} %"
+            )
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from ad5933 import AD5933
+
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    impedance = AD5933()
+    impedance.cal_range(impedance.range)
+    # sequential baseline, then pipelined with the same processing load
+    t_start = time.monotonic()
+    for _ in range(repeats):
+        impedance.sweep(10000, 1000, 90)
+    sequential = repeats / (time.monotonic() - t_start) * 60
+    pipeline = SweepPipeline(impedance, 10000, 1000, 90)
+    for i, _ in enumerate(pipeline):
+        if i + 1 == repeats:
+            break
+    print(f"sequential: {sequential:.1f} sweeps/min")
+    print(
+        f"pipelined:  {pipeline.throughput:.1f} sweeps/min, "
+        f"duty cycle {pipeline.duty_cycle * 100:.0f} %"
+    )
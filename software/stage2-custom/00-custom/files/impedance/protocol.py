@@ -0,0 +1,297 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+# Unattended measurement protocols. A protocol is a JSON file like
+#
+# {
+#     "output": "~/data/drying",
+#     "steps": [
+#         {"type": "range", "range": 2},
+#         {"type": "calibrate", "clock": 9000000},
+#         {"type": "repeat", "times": 48, "steps": [
+#             {"type": "sweep", "start": 1000, "increment": 1000, "points": 90},
+#             {"type": "continuous", "f": 10000, "minutes": 30, "interval": 1},
+#             {"type": "wait_temperature", "T": 40, "tolerance": 0.5}
+#         ]}
+#     ]
+# }
+#
+# "verify": true on a calibrate step checks the calibration on record for
+# that clock and re-measures only what drifted, see AD5933.verify_range().
+#
+# Progress, calibrations and data are checkpointed to the output directory,
+# running the same protocol again resumes where it left off.
+
+import csv
+import json
+import logging
+import os
+import signal
+import time
+from threading import Event
+
+import ad5933
+from ad5933 import AD5933
+from export import CONTINUOUS_FIELDS, SWEEP_FIELDS
+from mcp9600 import MCP9600
+from sampler import TemperatureSampler
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# seconds between checkpoints during continuous steps
+CHECKPOINT_INTERVAL = 60
+# temperature has to stay within tolerance this long (in s)
+HOLD_TIME = 60
+WAIT_TIMEOUT = 3600
+TCOUPLE_FILTER = 2
+
+
+def flatten(steps):
+    # expand repeat blocks so every step has a stable index
+    flat = []
+    for step in steps:
+        if step["type"] == "repeat":
+            for _ in range(step["times"]):
+                flat.extend(flatten(step["steps"]))
+        else:
+            flat.append(step)
+    return flat
+
+
+def estimate(steps, clock, cal_freqs=ad5933.CAL_FREQS):
+    # estimated runtime in seconds, waits for temperature count with their
+    # hold time only
+    total = 0
+    for step in steps:
+        kind = step["type"]
+        if kind == "clock":
+            clock = step["clock"]
+        elif kind == "calibrate":
+            clock = step.get("clock", clock)
+            low, high = ad5933.clock_limits(clock)
+            freqs = [f for f in cal_freqs if low <= f <= high]
+            if step.get("verify"):
+                # nothing drifted
+                freqs = freqs[:: max(len(freqs) // ad5933.VERIFY_POINTS, 1)]
+            total += sum(
+                ad5933.sweep_time(f, 0, ad5933.SAMPLES_PER_POINT, clock) for f in freqs
+            )
+        elif kind == "sweep":
+            total += ad5933.sweep_time(
+                step["start"], step["increment"], step["points"], clock
+            )
+        elif kind == "continuous":
+            total += step["minutes"] * 60
+        elif kind == "wait_temperature":
+            total += step.get("hold", HOLD_TIME)
+        elif kind == "pause":
+            total += step["minutes"] * 60
+    return total
+
+
+def format_duration(seconds):
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+class ProtocolRunner:
+    def __init__(self, impedance, thermo, plan):
+        self.impedance = impedance
+        self.thermo = thermo
+        self.plan = plan
+        self.steps = flatten(plan["steps"])
+        self.output = os.path.expanduser(plan.get("output", "~/data/protocol"))
+        self.checkpoint_file = os.path.join(self.output, "checkpoint.json")
+        self.state = {"plan": plan, "step": 0, "progress": {}, "calibrations": []}
+        self.stop_event = Event()
+        os.makedirs(self.output, exist_ok=True)
+
+    def resume(self):
+        try:
+            with open(self.checkpoint_file) as fh:
+                state = json.load(fh)
+        except FileNotFoundError:
+            return False
+        if state["plan"] != self.plan:
+            raise RuntimeError(
+                f"{self.checkpoint_file} belongs to a different protocol, "
+                "remove it to start over"
+            )
+        self.state = state
+        # calibrations are loaded for the clock that is active
+        if "clock" in state:
+            self.impedance.use_clock(state["clock"])
+        if state["calibrations"]:
+            self.impedance.import_calibrations(state["calibrations"])
+        if "range" in state:
+            self.impedance.range = state["range"]
+        return True
+
+    def checkpoint(self):
+        self.state["range"] = self.impedance.range
+        self.state["clock"] = self.impedance.clock
+        with open(self.checkpoint_file + ".tmp", "w") as fh:
+            json.dump(self.state, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(self.checkpoint_file + ".tmp", self.checkpoint_file)
+
+    def remaining(self):
+        step = self.state["step"]
+        total = estimate(self.steps[step:], self.impedance.clock)
+        if step < len(self.steps) and self.steps[step]["type"] == "continuous":
+            total -= self.state["progress"].get("elapsed", 0)
+        return total
+
+    def run(self):
+        logger.info(
+            f"{len(self.steps)} steps, estimated runtime "
+            f"{format_duration(estimate(self.steps, self.impedance.clock))}"
+        )
+        while self.state["step"] < len(self.steps) and not self.stop_event.is_set():
+            index = self.state["step"]
+            step = self.steps[index]
+            logger.info(
+                f"step {index + 1}/{len(self.steps)}: {step['type']}, "
+                f"{format_duration(self.remaining())} remaining"
+            )
+            # step functions return False when stopped before finishing
+            if getattr(self, f"_{step['type']}")(index, step) is not False:
+                self.state["step"] += 1
+                self.state["progress"] = {}
+                self.checkpoint()
+        self.checkpoint()
+        if self.state["step"] == len(self.steps):
+            logger.info("protocol finished")
+            return True
+        logger.info("protocol interrupted, rerun to resume")
+        return False
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    def _filename(self, index, step):
+        return os.path.join(self.output, f"step-{index + 1:04d}-{step['type']}.csv")
+
+    def _range(self, index, step):
+        self.impedance.range = step["range"]
+
+    def _clock(self, index, step):
+        self.impedance.use_clock(step["clock"])
+
+    def _calibrate(self, index, step):
+        index_ = step.get("range", self.impedance.range)
+        if step.get("verify"):
+            if "clock" in step:
+                self.impedance.use_clock(step["clock"])
+            self.impedance.verify_range(index_)
+        else:
+            if "clock" in step:
+                self.impedance.clock_frequency = step["clock"]
+            if step.get("adaptive"):
+                self.impedance.cal_range_adaptive(index_)
+            else:
+                self.impedance.cal_range(index_)
+        self.state["calibrations"] = self.impedance.export_calibrations()
+
+    def _sweep(self, index, step):
+        data = self.impedance.sweep(step["start"], step["increment"], step["points"])
+        filename = self._filename(index, step)
+        # written in one go, an interrupted sweep is simply repeated
+        with open(filename + ".tmp", "w") as fh:
+            writer = csv.DictWriter(fh, fieldnames=SWEEP_FIELDS + ("time",))
+            writer.writeheader()
+            now = time.time()
+            for point in data:
+                writer.writerow({**point, "index": index + 1, "time": now})
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(filename + ".tmp", filename)
+
+    def _continuous(self, index, step):
+        # duration counts measurement time, a restart does not eat into it
+        progress = self.state["progress"]
+        elapsed = progress.get("elapsed", 0)
+        duration = step["minutes"] * 60
+        interval = step.get("interval", 1)
+        filename = self._filename(index, step)
+        with open(filename, "a") as fh:
+            # rows written after the last checkpoint are measured again
+            fh.truncate(progress.get("offset", 0))
+            writer = csv.DictWriter(fh, fieldnames=CONTINUOUS_FIELDS + ("time",))
+            if not progress.get("offset"):
+                writer.writeheader()
+            t_checkpoint = time.monotonic()
+            while elapsed < duration and not self.stop_event.is_set():
+                t_start = time.monotonic()
+                magnitude, phase = self.impedance.measure(step["f"])
+                t = (t_start + time.monotonic()) / 2
+                writer.writerow(
+                    {
+                        "index": index + 1,
+                        "f": step["f"],
+                        "t": round(elapsed, 3),
+                        "magnitude": magnitude,
+                        "phase": phase,
+                        "T": self.thermo.at(t),
+                        "time": time.time(),
+                    }
+                )
+                fh.flush()
+                self.stop_event.wait(max(0, t_start + interval - time.monotonic()))
+                elapsed += time.monotonic() - t_start
+                progress["elapsed"] = elapsed
+                progress["offset"] = fh.tell()
+                if time.monotonic() - t_checkpoint > CHECKPOINT_INTERVAL:
+                    os.fsync(fh.fileno())
+                    self.checkpoint()
+                    t_checkpoint = time.monotonic()
+            os.fsync(fh.fileno())
+        return elapsed >= duration
+
+    def _wait_temperature(self, index, step):
+        tolerance = step.get("tolerance", 0.5)
+        hold = step.get("hold", HOLD_TIME)
+        deadline = time.monotonic() + step.get("timeout", WAIT_TIMEOUT)
+        t_within = None
+        while not self.stop_event.is_set():
+            latest = self.thermo.latest
+            if latest is not None and abs(latest[1] - step["T"]) <= tolerance:
+                t_within = t_within or time.monotonic()
+                if time.monotonic() - t_within >= hold:
+                    return
+            else:
+                t_within = None
+            if time.monotonic() > deadline:
+                logger.warning(f"timeout waiting for {step['T']} ℃, continuing")
+                return
+            self.stop_event.wait(1)
+        return False
+
+    def _pause(self, index, step):
+        return not self.stop_event.wait(step["minutes"] * 60)
+
+
+if __name__ == "__main__":
+    import sys
+
+    logger.setLevel(logging.INFO)
+    with open(sys.argv[1]) as fh:
+        plan = json.load(fh)
+    if "--estimate" in sys.argv:
+        steps = flatten(plan["steps"])
+        print(format_duration(estimate(steps, plan.get("clock", ad5933.CLOCK_FREQ))))
+        sys.exit(0)
+    thermo = TemperatureSampler(MCP9600(), filter_level=TCOUPLE_FILTER)
+    runner = ProtocolRunner(AD5933(), thermo, plan)
+    signal.signal(signal.SIGINT, runner.stop)
+    signal.signal(signal.SIGTERM, runner.stop)
+    if runner.resume():
+        logger.info(f"resuming at step {runner.state['step'] + 1}")
+    thermo.start()
+    try:
+        runner.run()
+    finally:
+        thermo.stop()
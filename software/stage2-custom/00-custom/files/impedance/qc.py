@@ -0,0 +1,314 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+# Pass/fail production check against a reference spectrum. The reference is
+# recorded once on a golden part: an averaged sweep on a coarse linear grid
+# of at most QC_POINTS frequencies, a tolerance envelope per frequency and
+# the fewest settling cycles whose error still leaves SETTLING_MARGIN of the
+# envelope for the parts. Checking a part is then a single short hardware
+# sweep and a vectorized comparison, every verdict is appended to a CSV log.
+
+import csv
+import json
+import logging
+import os
+from math import ceil
+from time import monotonic, strftime
+
+import numpy as np
+
+import metrics
+from ad5933 import sweep_time
+from stats import average_sweeps
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+QC_REFERENCE_FILE = os.path.expanduser("~/.config/impedance/qc_reference.json")
+QC_LOG_FILE = os.path.expanduser("~/.local/share/impedance/qc_results.csv")
+QC_POINTS = 20
+# golden sweeps averaged into the reference
+REFERENCE_SWEEPS = 5
+# envelope: at least these, or the golden part's noise times NOISE_FACTOR
+MAGNITUDE_TOLERANCE = 2.0  # %
+PHASE_TOLERANCE = 1.0  # °
+NOISE_FACTOR = 4
+# fraction of the envelope the settling error may use up
+SETTLING_MARGIN = 0.25
+SETTLING_CANDIDATES = (1, 2, 3, 5, 7, 10, 15, 20, 30, 50)
+LOG_FIELDS = (
+    "time",
+    "part",
+    "verdict",
+    "margin",
+    "f",
+    "quantity",
+    "deviation",
+    "duration",
+)
+
+
+def qc_grid(start, increment, points, max_points=QC_POINTS):
+    # every n-th point of a linear sweep, still one hardware sweep
+    step = max(ceil(points / max_points), 1)
+    return start, increment * step, points // step
+
+
+class Reference:
+    def __init__(
+        self,
+        start,
+        increment,
+        points,
+        magnitude,
+        phase,
+        magnitude_tolerance,
+        phase_tolerance,
+        settling_cycles,
+        range_,
+        clock,
+        sweep_settling_cycles,
+    ):
+        self.start = start
+        self.increment = increment
+        self.points = points
+        self.magnitude = np.asarray(magnitude, dtype=float)
+        self.phase = np.asarray(phase, dtype=float)
+        # relative, and in degrees
+        self.magnitude_tolerance = np.asarray(magnitude_tolerance, dtype=float)
+        self.phase_tolerance = np.asarray(phase_tolerance, dtype=float)
+        self.settling_cycles = settling_cycles
+        self.range = range_
+        self.clock = clock
+        # of the setup the reference was recorded with
+        self.sweep_settling_cycles = sweep_settling_cycles
+
+    @property
+    def freqs(self):
+        return self.start + self.increment * np.arange(self.points + 1)
+
+    @property
+    def duration(self):
+        # estimated hardware time of a check
+        return sweep_time(
+            self.start, self.increment, self.points, self.clock, self.settling_cycles
+        )
+
+    def deviations(self, magnitude, phase):
+        # relative |Z| and phase deviation, and both in units of the envelope
+        magnitude_deviation = np.asarray(magnitude) / self.magnitude - 1
+        phase_deviation = np.asarray(phase) - self.phase
+        normalized = np.vstack(
+            (
+                np.abs(magnitude_deviation) / self.magnitude_tolerance,
+                np.abs(phase_deviation) / self.phase_tolerance,
+            )
+        )
+        return magnitude_deviation, phase_deviation, normalized
+
+    def verdict(self, magnitude, phase):
+        magnitude_deviation, phase_deviation, normalized = self.deviations(
+            magnitude, phase
+        )
+        quantity, i = np.unravel_index(np.argmax(normalized), normalized.shape)
+        margin = float(normalized[quantity, i])
+        if quantity == 0:
+            deviation = float(magnitude_deviation[i]) * 100
+        else:
+            deviation = float(phase_deviation[i])
+        return {
+            "verdict": "pass" if margin <= 1 else "fail",
+            "margin": margin,
+            "f": int(self.freqs[i]),
+            "quantity": ("magnitude", "phase")[quantity],
+            # % for magnitude, ° for phase
+            "deviation": deviation,
+        }
+
+    def to_dict(self):
+        return {
+            "start": self.start,
+            "increment": self.increment,
+            "points": self.points,
+            "magnitude": self.magnitude.tolist(),
+            "phase": self.phase.tolist(),
+            "magnitude_tolerance": self.magnitude_tolerance.tolist(),
+            "phase_tolerance": self.phase_tolerance.tolist(),
+            "settling_cycles": self.settling_cycles,
+            "range": self.range,
+            "clock": self.clock,
+            "sweep_settling_cycles": self.sweep_settling_cycles,
+        }
+
+    def save(self, filename=QC_REFERENCE_FILE):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + ".tmp", "w") as fh:
+            json.dump(self.to_dict(), fh)
+        os.replace(filename + ".tmp", filename)
+
+    @classmethod
+    def load(cls, filename=QC_REFERENCE_FILE):
+        with open(filename) as fh:
+            data = json.load(fh)
+        data["range_"] = data.pop("range")
+        return cls(**data)
+
+
+def measure(impedance, start, increment, points, settling_cycles):
+    previous = impedance.settling_cycles
+    impedance.settling_cycles = settling_cycles
+    try:
+        data = impedance.sweep(start, increment, points)
+    finally:
+        impedance.settling_cycles = previous
+    return [p["magnitude"] for p in data], [p["phase"] for p in data]
+
+
+def record(
+    impedance,
+    start,
+    increment,
+    points,
+    magnitude_tolerance=MAGNITUDE_TOLERANCE,
+    phase_tolerance=PHASE_TOLERANCE,
+    max_points=QC_POINTS,
+    sweeps=REFERENCE_SWEEPS,
+):
+    # golden part connected, tolerances in % and °
+    start, increment, points = qc_grid(start, increment, points, max_points)
+    result = None
+    for result in average_sweeps(
+        lambda: impedance.sweep(start, increment, points), sweeps
+    ):
+        pass
+    magnitude, phase = result["magnitude"], result["phase"]
+    noise_magnitude = np.nan_to_num(magnitude.std / magnitude.mean)
+    noise_phase = np.nan_to_num(phase.std)
+    reference = Reference(
+        start,
+        increment,
+        points,
+        magnitude.mean,
+        phase.mean,
+        np.maximum(magnitude_tolerance / 100, NOISE_FACTOR * noise_magnitude),
+        np.maximum(phase_tolerance, NOISE_FACTOR * noise_phase),
+        impedance.settling_cycles,
+        impedance.range,
+        impedance.clock,
+        impedance.settling_cycles,
+    )
+    # fewest settling cycles that keep the margin on the golden part
+    for cycles in SETTLING_CANDIDATES:
+        if cycles >= impedance.settling_cycles:
+            break
+        _, _, normalized = reference.deviations(
+            *measure(impedance, start, increment, points, cycles)
+        )
+        if normalized.max() <= SETTLING_MARGIN:
+            reference.settling_cycles = cycles
+            break
+    logger.info(
+        f"QC reference: {points + 1} points from {start} Hz, "
+        f"{reference.settling_cycles} settling cycles, "
+        f"~{reference.duration * 1000:.0f} ms per check"
+    )
+    return reference
+
+
+def mismatches(impedance, reference, start, increment, points, max_points=QC_POINTS):
+    # settings of the current setup that differ from the reference's
+    current = {
+        "range": (impedance.range, reference.range),
+        "clock": (impedance.clock, reference.clock),
+        "settling cycles": (
+            impedance.settling_cycles,
+            reference.sweep_settling_cycles,
+        ),
+        "frequencies": (
+            qc_grid(start, increment, points, max_points),
+            (reference.start, reference.increment, reference.points),
+        ),
+    }
+    return [
+        f"{name}: {now} now, {then} in the reference"
+        for name, (now, then) in current.items()
+        if now != then
+    ]
+
+
+def check(impedance, reference, start, increment, points, max_points=QC_POINTS):
+    # start, increment, points and max_points as for record()
+    mismatched = mismatches(impedance, reference, start, increment, points, max_points)
+    if mismatched:
+        raise ValueError(
+            "reference does not match the setup, record it again ("
+            + "; ".join(mismatched)
+            + ")"
+        )
+    t_start = monotonic()
+    with metrics.span("qc.check"):
+        result = reference.verdict(
+            *measure(
+                impedance,
+                reference.start,
+                reference.increment,
+                reference.points,
+                reference.settling_cycles,
+            )
+        )
+    result["duration"] = monotonic() - t_start
+    metrics.count(f"qc.{result['verdict']}")
+    return result
+
+
+class ResultsLog:
+    # one CSV row per checked part
+    def __init__(self, filename=QC_LOG_FILE):
+        self.filename = filename
+        try:
+            with open(filename) as fh:
+                self.parts = max(sum(1 for _ in fh) - 1, 0)
+        except FileNotFoundError:
+            self.parts = 0
+
+    def append(self, result):
+        self.parts += 1
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        new = not os.path.exists(self.filename)
+        with open(self.filename, "a", newline="") as fh:
+            writer = csv.DictWriter(fh, fieldnames=LOG_FIELDS, extrasaction="ignore")
+            if new:
+                writer.writeheader()
+            writer.writerow(
+                {
+                    **result,
+                    "time": strftime("%Y-%m-%dT%H:%M:%S"),
+                    "part": self.parts,
+                    "margin": f"{result['margin']:.3f}",
+                    "deviation": f"{result['deviation']:.4g}",
+                    "duration": f"{result['duration']:.3f}",
+                }
+            )
+        return self.parts
+
+
+if __name__ == "__main__":
+    from ad5933 import AD5933
+    from simulator import SimulatedBoard, parallel_rc
+
+    # golden part and one slightly off, on the simulated board
+    board = SimulatedBoard(parallel_rc(1000, 1e-9))
+    board.install()
+    impedance = AD5933(backend=board)
+    impedance.cal_range(2)
+    reference = record(impedance, 1000, 1000, 90)
+    for C in (1e-9, 1.1e-9, 1.5e-9):
+        board.dut = parallel_rc(1000, C)
+        elapsed = board.elapsed
+        result = check(impedance, reference, 1000, 1000, 90)
+        print(
+            f"C = {C * 1e9:.1f} nF: {result['verdict']}, margin "
+            f"{result['margin']:.2f}, worst {result['quantity']} at {result['f']} Hz "
+            f"({result['deviation']:+.2f}), {(board.elapsed - elapsed) * 1000:.0f} ms"
+        )
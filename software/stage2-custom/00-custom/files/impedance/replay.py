@@ -0,0 +1,476 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+# Record and replay of raw hardware traffic. A recording captures IIO
+# attribute accesses and buffer payloads of the AD5933 as well as the I2C
+# traffic of the ADG729 and MCP9600, one gzipped JSON line per access:
+#
+# [t, source, operation, args, result]
+#
+# Replaying serves the results back in the same order per source, so the
+# processing, calibration and logging code runs bit-exact without hardware.
+#
+# python replay.py record run.rec.gz   # on the instrument
+# python replay.py run.rec.gz          # anywhere, prints the timings
+
+import base64
+import gzip
+import json
+import logging
+import os
+from collections import defaultdict, deque
+from threading import Lock
+from time import monotonic, sleep
+
+import metrics
+from i2c import RASPI_BUS, I2CBus
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+
+def _encode(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {"bytes": base64.b64encode(value).decode()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if "errno" in value:
+            raise OSError(value["errno"], os.strerror(value["errno"]))
+        return base64.b64decode(value["bytes"])
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+class Recorder:
+    def __init__(self, filename):
+        self.fh = gzip.open(filename, "wt")
+        self.t0 = monotonic()
+        self._lock = Lock()
+
+    def close(self):
+        with self._lock:
+            self.fh.close()
+
+    def call(self, source, op, func, *args):
+        try:
+            result = func(*args)
+        except OSError as e:
+            self._write(source, op, args, {"errno": e.errno})
+            raise
+        self._write(source, op, args, _encode(result))
+        return result
+
+    def _write(self, source, op, args, result):
+        line = [round(monotonic() - self.t0, 6), source, op, _encode(args), result]
+        with self._lock:
+            self.fh.write(json.dumps(line) + "\n")
+
+    def install(self, buses=(RASPI_BUS,)):
+        for bus in buses:
+            i2c = I2CBus.get(bus)
+            i2c.smbus = _RecordingSMBus(self, f"i2c-{bus}", i2c.smbus)
+
+    def iio(self):
+        import iio
+
+        return _RecordingBackend(self, iio)
+
+    def thermocouple(self, bus=RASPI_BUS, **kwargs):
+        from mcp9600 import MCP9600
+
+        thermo = MCP9600(bus, **kwargs)
+        thermo.fd = _RecordingFile(self, thermo.name, thermo.fd)
+        return thermo
+
+
+class _RecordingSMBus:
+    def __init__(self, recorder, source, smbus):
+        self.recorder = recorder
+        self.source = source
+        self.smbus = smbus
+
+    def read_byte(self, addr):
+        return self.recorder.call(self.source, "read_byte", self.smbus.read_byte, addr)
+
+    def write_byte(self, addr, value):
+        return self.recorder.call(
+            self.source, "write_byte", self.smbus.write_byte, addr, value
+        )
+
+    def read_i2c_block_data(self, addr, reg, size):
+        return self.recorder.call(
+            self.source,
+            "read_i2c_block_data",
+            self.smbus.read_i2c_block_data,
+            addr,
+            reg,
+            size,
+        )
+
+
+class _RecordingFile:
+    def __init__(self, recorder, source, fd):
+        self.recorder = recorder
+        self.source = source
+        self.fd = fd
+
+    def read(self, size):
+        return self.recorder.call(self.source, "read", self.fd.read, size)
+
+    def write(self, data):
+        return self.recorder.call(self.source, "write", self.fd.write, data)
+
+
+class _RecordingBackend:
+    def __init__(self, recorder, iio):
+        self.recorder = recorder
+        self.iio = iio
+
+    def Context(self):
+        return _RecordingContext(self.recorder, self.iio.Context())
+
+    def Buffer(self, dev, samples):
+        buf = self.iio.Buffer(dev.dev, samples)
+        self.recorder._write(f"{dev.id}/buffer", "create", (samples,), None)
+        return _RecordingBuffer(self.recorder, f"{dev.id}/buffer", buf)
+
+
+class _RecordingContext:
+    def __init__(self, recorder, ctx):
+        self.recorder = recorder
+        self.ctx = ctx
+
+    def set_timeout(self, timeout):
+        self.ctx.set_timeout(timeout)
+
+    @property
+    def devices(self):
+        devices = self.ctx.devices
+        self.recorder._write(
+            "context", "devices", (), [[dev.id, dev.name] for dev in devices]
+        )
+        return [_RecordingDevice(self.recorder, dev) for dev in devices]
+
+    def find_device(self, name):
+        dev = self.ctx.find_device(name)
+        self.recorder._write("context", "find_device", (name,), dev and dev.id)
+        return dev and _RecordingDevice(self.recorder, dev)
+
+
+class _RecordingDevice:
+    def __init__(self, recorder, dev):
+        self.recorder = recorder
+        self.dev = dev
+        self.id = dev.id
+        self.name = dev.name
+        self.attrs = _RecordingAttrs(recorder, dev.id, dev.attrs)
+
+    def set_kernel_buffers_count(self, count):
+        self.dev.set_kernel_buffers_count(count)
+
+    def find_channel(self, name, is_output=False):
+        channel = self.dev.find_channel(name, is_output)
+        source = f"{self.id}/{name}{'-out' if is_output else ''}"
+        self.recorder._write(source, "find", (), channel is not None)
+        return channel and _RecordingChannel(self.recorder, source, channel)
+
+
+class _RecordingChannel:
+    def __init__(self, recorder, source, channel):
+        self.recorder = recorder
+        self.source = source
+        self.channel = channel
+        self.attrs = _RecordingAttrs(recorder, source, channel.attrs)
+
+    @property
+    def enabled(self):
+        return self.channel.enabled
+
+    @enabled.setter
+    def enabled(self, value):
+        def enable(value):
+            self.channel.enabled = value
+
+        self.recorder.call(self.source, "enable", enable, value)
+
+    def read(self, buf):
+        return self.recorder.call(
+            self.source, "read", lambda: self.channel.read(buf.buf)
+        )
+
+
+class _RecordingBuffer:
+    def __init__(self, recorder, source, buf):
+        self.recorder = recorder
+        self.source = source
+        self.buf = buf
+
+    def refill(self):
+        self.recorder.call(self.source, "refill", self.buf.refill)
+
+    def read(self):
+        return self.recorder.call(self.source, "read", self.buf.read)
+
+    def cancel(self):
+        self.buf.cancel()
+
+
+class _RecordingAttrs:
+    def __init__(self, recorder, source, attrs):
+        self.recorder = recorder
+        self.source = source
+        self.attrs = attrs
+        # same object per name, AD5933 caches written values by attribute
+        self._cache = {}
+
+    def __getitem__(self, name):
+        if name not in self._cache:
+            self._cache[name] = _RecordingAttr(
+                self.recorder, f"{self.source}:{name}", self.attrs[name]
+            )
+        return self._cache[name]
+
+
+class _RecordingAttr:
+    def __init__(self, recorder, source, attr):
+        self.recorder = recorder
+        self.source = source
+        self.attr = attr
+
+    @property
+    def value(self):
+        return self.recorder.call(self.source, "get", lambda: self.attr.value)
+
+    @value.setter
+    def value(self, value):
+        def write(value):
+            self.attr.value = value
+
+        self.recorder.call(self.source, "set", write, value)
+
+
+class Replayer:
+    def __init__(self, filename, realtime=False):
+        # per source, so interleaving between threads does not matter
+        self.records = defaultdict(deque)
+        with gzip.open(filename, "rt") as fh:
+            for line in fh:
+                t, source, op, args, result = json.loads(line)
+                self.records[source].append((t, op, args, result))
+        self.realtime = realtime
+        self.t0 = monotonic()
+        self._lock = Lock()
+
+    def call(self, source, op, *args):
+        with self._lock:
+            try:
+                t, op_, args_, result = self.records[source].popleft()
+            except IndexError:
+                raise RuntimeError(f"recording exhausted at {source} {op}{args}")
+        if (op_, args_) != (op, _encode(args)):
+            raise RuntimeError(
+                f"replay diverged at {source}: expected {op_}{args_}, got {op}{args}"
+            )
+        if self.realtime:
+            sleep(max(0, self.t0 + t - monotonic()))
+        return _decode(result)
+
+    def remaining(self):
+        return sum(len(records) for records in self.records.values())
+
+    def install(self):
+        buses = {
+            int(source.split("-")[1])
+            for source in self.records
+            if source.startswith("i2c-")
+        }
+        for bus in buses:
+            I2CBus.get(bus).smbus = _ReplaySMBus(self, f"i2c-{bus}")
+
+    def iio(self):
+        return _ReplayBackend(self)
+
+    def thermocouple(self, bus=RASPI_BUS, **kwargs):
+        from mcp9600 import MCP9600, MCP9600_ADDR
+
+        addr = kwargs.get("addr", MCP9600_ADDR)
+        fd = _ReplayFile(self, f"mcp9600@{addr:#04x}")
+        return MCP9600(bus, fd=fd, **kwargs)
+
+
+class _ReplaySMBus:
+    def __init__(self, replayer, source):
+        self.replayer = replayer
+        self.source = source
+
+    def read_byte(self, addr):
+        return self.replayer.call(self.source, "read_byte", addr)
+
+    def write_byte(self, addr, value):
+        return self.replayer.call(self.source, "write_byte", addr, value)
+
+    def read_i2c_block_data(self, addr, reg, size):
+        return self.replayer.call(self.source, "read_i2c_block_data", addr, reg, size)
+
+
+class _ReplayFile:
+    def __init__(self, replayer, source):
+        self.replayer = replayer
+        self.source = source
+
+    def read(self, size):
+        return self.replayer.call(self.source, "read", size)
+
+    def write(self, data):
+        return self.replayer.call(self.source, "write", data)
+
+
+class _ReplayBackend:
+    def __init__(self, replayer):
+        self.replayer = replayer
+
+    def Context(self):
+        return _ReplayContext(self.replayer)
+
+    def Buffer(self, dev, samples):
+        self.replayer.call(f"{dev.id}/buffer", "create", samples)
+        return _ReplayBuffer(self.replayer, f"{dev.id}/buffer")
+
+
+class _ReplayContext:
+    def __init__(self, replayer):
+        self.replayer = replayer
+
+    def set_timeout(self, timeout):
+        pass
+
+    @property
+    def devices(self):
+        return [
+            _ReplayDevice(self.replayer, id_, name)
+            for id_, name in self.replayer.call("context", "devices")
+        ]
+
+    def find_device(self, name):
+        id_ = self.replayer.call("context", "find_device", name)
+        return id_ and _ReplayDevice(self.replayer, id_, "ad5933")
+
+
+class _ReplayDevice:
+    def __init__(self, replayer, id_, name):
+        self.replayer = replayer
+        self.id = id_
+        self.name = name
+        self.attrs = _ReplayAttrs(replayer, id_)
+
+    def set_kernel_buffers_count(self, count):
+        pass
+
+    def find_channel(self, name, is_output=False):
+        source = f"{self.id}/{name}{'-out' if is_output else ''}"
+        if self.replayer.call(source, "find"):
+            return _ReplayChannel(self.replayer, source)
+        return None
+
+
+class _ReplayChannel:
+    def __init__(self, replayer, source):
+        self.replayer = replayer
+        self.source = source
+        self.attrs = _ReplayAttrs(replayer, source)
+
+    @property
+    def enabled(self):
+        return True
+
+    @enabled.setter
+    def enabled(self, value):
+        self.replayer.call(self.source, "enable", value)
+
+    def read(self, buf):
+        return self.replayer.call(self.source, "read")
+
+
+class _ReplayBuffer:
+    def __init__(self, replayer, source):
+        self.replayer = replayer
+        self.source = source
+
+    def refill(self):
+        self.replayer.call(self.source, "refill")
+
+    def read(self):
+        return self.replayer.call(self.source, "read")
+
+    def cancel(self):
+        pass
+
+
+class _ReplayAttrs:
+    def __init__(self, replayer, source):
+        self.replayer = replayer
+        self.source = source
+        self._cache = {}
+
+    def __getitem__(self, name):
+        if name not in self._cache:
+            self._cache[name] = _ReplayAttr(self.replayer, f"{self.source}:{name}")
+        return self._cache[name]
+
+
+class _ReplayAttr:
+    def __init__(self, replayer, source):
+        self.replayer = replayer
+        self.source = source
+
+    @property
+    def value(self):
+        return self.replayer.call(self.source, "get")
+
+    @value.setter
+    def value(self, value):
+        self.replayer.call(self.source, "set", value)
+
+
+def scenario(impedance, thermo, data_logger):
+    # fixed sequence of calibration, sweep and continuous samples
+    impedance.range = 2
+    impedance.cal_range(2)
+    data_logger.append_sweep(impedance.sweep(10000, 1000, 90))
+    series = data_logger.start_continuous()
+    for i in range(100):
+        magnitude, phase = impedance.measure(10000)
+        point = {"f": 10000, "t": i, "magnitude": magnitude, "phase": phase}
+        data_logger.append_continuous_point({**point, "T": thermo.temp}, series)
+    data_logger.export_to_string()
+
+
+if __name__ == "__main__":
+    import sys
+
+    from ad5933 import AD5933
+    from export import DataLogger
+
+    logger.setLevel(logging.INFO)
+    metrics.enable()
+    if sys.argv[1] == "record":
+        session = Recorder(sys.argv[2])
+    else:
+        session = Replayer(sys.argv[1], realtime="--realtime" in sys.argv)
+    session.install()
+    impedance = AD5933(backend=session.iio())
+    t_start = monotonic()
+    scenario(impedance, session.thermocouple(), DataLogger())
+    logger.info(f"scenario took {monotonic() - t_start:.3f} s")
+    if isinstance(session, Recorder):
+        session.close()
+    elif session.remaining():
+        logger.warning(f"{session.remaining()} recorded accesses not replayed")
+    print(metrics.render())
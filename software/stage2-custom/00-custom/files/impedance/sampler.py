@@ -0,0 +1,99 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+import logging
+from collections import deque
+from threading import Event, Lock, Thread
+from time import monotonic
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.25
+# ~17 minutes of history at the default interval
+BUFFER_LENGTH = 4096
+MAX_BACKOFF = 30
+# don't hold the last reading forever if the thermocouple is gone
+MAX_AGE = 10
+
+
+class TemperatureSampler:
+    def __init__(
+        self,
+        thermo,
+        interval=SAMPLE_INTERVAL,
+        length=BUFFER_LENGTH,
+        filter_level=None,
+    ):
+        self.thermo = thermo
+        self.interval = interval
+        self.filter_level = filter_level
+        self.samples = deque(maxlen=length)
+        self.errors = 0
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="thermocouple", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def latest(self):
+        with self._lock:
+            return self.samples[-1] if self.samples else None
+
+    def at(self, t):
+        # linear interpolation between the two readings around t
+        with self._lock:
+            if not self.samples:
+                return float("nan")
+            newer = None
+            for sample in reversed(self.samples):
+                if sample[0] <= t:
+                    break
+                newer = sample
+            else:
+                # t predates the buffer
+                return newer[1]
+        t0, T0 = sample
+        if newer is None:
+            return T0 if t - t0 <= MAX_AGE else float("nan")
+        t1, T1 = newer
+        return T0 + (T1 - T0) * (t - t0) / (t1 - t0)
+
+    def _retry(self, func):
+        backoff = self.interval
+        while not self._stop.is_set():
+            try:
+                return func()
+            except OSError as e:
+                self.errors += 1
+                logger.debug(f"thermocouple error, retrying in {backoff} s: {e}")
+                self._stop.wait(backoff)
+                backoff = min(2 * backoff, MAX_BACKOFF)
+
+    def _read(self):
+        t = monotonic()
+        T = self.thermo.temp
+        # timestamp the middle of the I2C transaction
+        return (t + monotonic()) / 2, T
+
+    def _run(self):
+        logger.debug("starting thermocouple sampler")
+        if self.filter_level is not None:
+            self._retry(lambda: self.thermo.enable_filter(self.filter_level))
+            logger.debug(f"set thermocouple filter to level {self.filter_level}")
+        while not self._stop.is_set():
+            t_start = monotonic()
+            sample = self._retry(self._read)
+            if sample is None:
+                break
+            with self._lock:
+                self.samples.append(sample)
+            self._stop.wait(max(0, t_start + self.interval - monotonic()))
+        logger.debug("stopping thermocouple sampler")
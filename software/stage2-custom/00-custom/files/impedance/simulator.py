@@ -0,0 +1,238 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+# Simulated AD5933 board for AD5933(backend=...), see also replay.py. The
+# mux selects either the calibration resistor of a range or the DUT, the
+# signal path adds a frequency dependent gain and phase, incomplete settling
+# depending on frequency and load, noise and 16 bit quantization. Acquisition
+# time follows the driver timing model and is accumulated in elapsed instead
+# of slept.
+
+import cmath
+import math
+import struct
+from random import Random
+
+from ad5933 import CAL_RANGES, INIT_EXCITATION_TIME, OUTPUT_VOLTAGES, point_time
+from i2c import RASPI_BUS, I2CBus
+
+# DFT magnitude when the DUT matches the calibration resistor of the range
+FULL_SCALE = 5000
+# relative noise of a single DFT at full output voltage
+NOISE = 2e-3
+# relative transient error, decays with the settling cycles, grows towards
+# low frequencies below SETTLING_CORNER and with the reactance of the load
+SETTLING_ERROR = 0.05
+SETTLING_DECAY = 3
+SETTLING_CORNER = 1000
+# corner of the signal path and the phase anomaly around 300-600 Hz
+CORNER = 200000
+ANOMALY = (450, 0.02)
+
+
+def parallel_rc(R, C=0):
+    return lambda f: 1 / (1 / R + 2j * math.pi * f * C)
+
+
+class SimulatedBoard:
+    def __init__(self, dut=parallel_rc(1000), seed=0):
+        self.dut = dut
+        self.random = Random(seed)
+        self.elapsed = 0.0
+        self.mux = 0
+        self.attrs = {
+            "clock_frequency": "9000000",
+            "frequency_start": "30000",
+            "frequency_increment": "0",
+            "frequency_points": "0",
+            "settling_cycles": "10",
+            "raw": OUTPUT_VOLTAGES[0],
+            "scale": "1",
+        }
+
+    def install(self, bus=RASPI_BUS):
+        I2CBus.get(bus).smbus = _SimulatedMux(self)
+
+    def Context(self):
+        return _Context(self)
+
+    def Buffer(self, dev, samples):
+        self.elapsed += INIT_EXCITATION_TIME
+        return _Buffer(self, samples)
+
+    def load(self, f):
+        # calibration switches in the low nibble, range switches in the high
+        cal = self.mux & 0x0F
+        if cal:
+            return CAL_RANGES[cal.bit_length()][3]
+        return self.dut(f)
+
+    def response(self, f):
+        clock = int(self.attrs["clock_frequency"])
+        settling = int(self.attrs["settling_cycles"])
+        self.elapsed += point_time(f, clock, settling)
+        feedback = CAL_RANGES[max((self.mux >> 4).bit_length(), 1)][3]
+        scale = int(self.attrs["raw"]) / int(OUTPUT_VOLTAGES[0])
+        scale *= 5 if self.attrs["scale"] == "0.2" else 1
+        center, width = ANOMALY
+        system = cmath.exp(1j * width / (1 + ((f - center) / (center / 4)) ** 2))
+        system /= 1 + 1j * f / CORNER
+        load = self.load(f)
+        signal = FULL_SCALE * scale * feedback / load * system
+        # the calibration resistor has no reactance, so calibration doesn't
+        # cancel the transient on a reactive DUT
+        transient = SETTLING_ERROR * math.exp(-settling / SETTLING_DECAY)
+        transient *= SETTLING_CORNER / f + abs(math.sin(cmath.phase(load)))
+        signal *= 1 + transient
+        noise = NOISE * FULL_SCALE * (
+            self.random.gauss(0, 1) + 1j * self.random.gauss(0, 1)
+        )
+        # phase of the DFT result runs opposite to the impedance phase
+        signal = signal.conjugate() + noise
+        return (
+            max(-32768, min(32767, round(signal.real))),
+            max(-32768, min(32767, round(signal.imag))),
+        )
+
+
+class _SimulatedMux:
+    def __init__(self, board):
+        self.board = board
+
+    def read_byte(self, addr):
+        return self.board.mux
+
+    def write_byte(self, addr, value):
+        self.board.mux = value
+
+
+class _Attr:
+    def __init__(self, board, name):
+        self.board = board
+        self.name = name
+
+    @property
+    def value(self):
+        return self.board.attrs[self.name]
+
+    @value.setter
+    def value(self, value):
+        self.board.attrs[self.name] = value
+
+
+class _TempAttr:
+    def __init__(self, value):
+        self.value = value
+
+
+class _Attrs:
+    def __init__(self, board):
+        self.board = board
+        self._cache = {}
+
+    def __getitem__(self, name):
+        if name not in self._cache:
+            self._cache[name] = _Attr(self.board, name)
+        return self._cache[name]
+
+
+class _Channel:
+    def __init__(self, board, index=None, attrs=None):
+        self.board = board
+        self.index = index
+        self.enabled = False
+        self.attrs = attrs or _Attrs(board)
+
+    def read(self, buf):
+        return struct.pack(
+            f"<{len(buf.samples)}h", *(sample[self.index] for sample in buf.samples)
+        )
+
+
+class _Device:
+    id = "iio:device0"
+    name = "ad5933"
+
+    def __init__(self, board):
+        self.board = board
+        self.attrs = _Attrs(board)
+        temp = {"raw": _TempAttr("800"), "scale": _TempAttr("31.25")}
+        self.channels = {
+            "voltage_real": _Channel(board, 0),
+            "voltage_imag": _Channel(board, 1),
+            "temp": _Channel(board, attrs=temp),
+        }
+
+    def set_kernel_buffers_count(self, count):
+        pass
+
+    def find_channel(self, name, is_output=False):
+        return self.channels.get(name, _Channel(self.board))
+
+
+class _Context:
+    def __init__(self, board):
+        self.devices = [_Device(board)]
+
+    def set_timeout(self, timeout):
+        pass
+
+    def find_device(self, name):
+        return self.devices[0]
+
+
+class _Buffer:
+    def __init__(self, board, size):
+        self.board = board
+        self.size = size
+        self.index = 0
+        self.samples = []
+
+    def refill(self):
+        attrs = self.board.attrs
+        start = int(attrs["frequency_start"])
+        increment = int(attrs["frequency_increment"])
+        freqs = (start + increment * (self.index + i) for i in range(self.size))
+        self.samples = [self.board.response(f) for f in freqs]
+        self.index += self.size
+
+    def read(self):
+        return b"".join(struct.pack("<hh", *sample) for sample in self.samples)
+
+    def cancel(self):
+        pass
+
+
+if __name__ == "__main__":
+    import sys
+
+    from ad5933 import AD5933
+
+    # adaptive against fixed grid calibration on a smooth load: the adaptive
+    # grid has to be cheaper and at least as accurate
+    R = 1000
+    results = {}
+    for name in ("fixed", "adaptive"):
+        board = SimulatedBoard(parallel_rc(R))
+        board.install()
+        impedance = AD5933(backend=board)
+        elapsed = board.elapsed
+        if name == "fixed":
+            impedance.cal_range(2)
+        else:
+            impedance.cal_range_adaptive(2)
+        elapsed = board.elapsed - elapsed
+        impedance.range = 2
+        error = max(
+            abs(p["magnitude"] / R - 1) for p in impedance.sweep(1000, 1000, 90)
+        )
+        results[name] = elapsed, len(impedance.cal_frequencies[2]), error
+        print(
+            f"{name}: {results[name][1]} points, {elapsed:.1f} s, "
+            f"max |Z| error {error * 100:.2f} %"
+        )
+    fixed, adaptive = results["fixed"], results["adaptive"]
+    if adaptive[0] >= fixed[0] or adaptive[2] > 1.5 * fixed[2]:
+        print("adaptive calibration does not beat the fixed grid")
+        sys.exit(1)
@@ -0,0 +1,250 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+# Accelerated soak test. The measurement paths of the GUI run headless
+# against the simulated board: ContinuousWidget's measurement thread at
+# SPEEDUP times real time, its timestamps and the data logger's rollups scaled
+# to match and the plot redrawn only every DRAW_INTERVAL seconds of wall time,
+# so a day of operation takes minutes, and SweepWidget.measure back to back:
+#
+# python soak.py [--days 1] [--interval 1] [--speedup 600] [--draw-interval 1]
+#                [--sweeps 2000] [--csv trend.csv]
+#
+# Every simulated hour (continuous) or SWEEP_WINDOW sweeps the RSS, thread
+# count, tick latency percentiles and plot cost are sampled. The run fails
+# with exit code 1 if any of them trends upward. Memory the data logger
+# holds by design is subtracted from the RSS before judging it.
+
+import argparse
+import csv
+import logging
+import math
+import os
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+
+import numpy as np
+from PySide2 import QtCore, QtWidgets
+
+import export
+import metrics
+import ui
+from boards import Board
+from health import rss
+from journal import Journal
+from sampler import TemperatureSampler
+from simulator import SimulatedBoard
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+RANGE = 2
+SAMPLE_PERIOD = 3600
+SWEEP = {"start": 10000, "increment": 1000, "points": 90}
+SWEEP_WINDOW = 50
+# simulated seconds per wall-clock second in continuous mode
+SPEEDUP = 600
+# seconds between checks of the continuous run's progress
+POLL_INTERVAL = 0.5
+# wall-clock seconds between redraws of the continuous plot, a redraw takes
+# longer than SPEEDUP allows for a tick
+DRAW_INTERVAL = 1
+# leading part of the run excluded from the trends
+WARMUP = 0.2
+# growth over the run that fails it: relative to the fitted initial level
+# and absolute, both must be exceeded
+TOLERANCES = {
+    "unaccounted": (0.2, 16e6),
+    "threads": (0, 2),
+    "tick_p50": (0.5, 1e-3),
+    "tick_p99": (1.0, 5e-3),
+    "plot": (0.5, 5e-3),
+}
+
+
+def board_temp(t):
+    # daily swing of the sample temperature
+    return 25 + 2 * math.sin(2 * math.pi * t / 86400)
+
+
+class Thermocouple:
+    # MCP9600 stand-in, follows board_temp on the simulated clock
+    def __init__(self, data_logger, interval):
+        self.data_logger = data_logger
+        self.interval = interval
+
+    @property
+    def temp(self):
+        return board_temp(self.data_logger.points * self.interval)
+
+
+def sample(t, ticks, plot, data_logger):
+    memory = rss()
+    ticks = np.array(ticks) if len(ticks) else np.zeros(1)
+    # the plot span only exists once something was drawn
+    histogram = metrics.spans.get(plot)
+    plots = list(histogram.recent) if histogram is not None else []
+    return {
+        "t": t,
+        "points": data_logger.points,
+        "rss": memory,
+        "unaccounted": memory - data_logger.memory_usage(),
+        "threads": threading.active_count(),
+        "tick_p50": float(np.percentile(ticks, 50)),
+        "tick_p99": float(np.percentile(ticks, 99)),
+        "plot": float(np.mean(plots)) if plots else None,
+    }
+
+
+def soak_continuous(board, data_logger, days, interval=1):
+    # one tick per simulated interval, paced by the widget at SPEEDUP times
+    # real time, tick latency is the acquisition span
+    board.thermo = TemperatureSampler(Thermocouple(data_logger, interval))
+    board.start()
+    widget = ui.ContinuousWidget(board.impedance, board, data_logger)
+    widget.start_stop()
+    samples = []
+    ticks = int(days * 86400 / interval)
+    window = max(int(SAMPLE_PERIOD / interval), 2)
+    try:
+        while data_logger.points < ticks:
+            sleep(POLL_INTERVAL)
+            points = data_logger.points
+            if points < len(samples) * window + window:
+                continue
+            acquire = metrics.spans.get("ui.acquire")
+            samples.append(
+                sample(
+                    points * interval / 3600,
+                    list(acquire.recent) if acquire is not None else [],
+                    "ui.continuous_draw",
+                    data_logger,
+                )
+            )
+            logger.info(f"continuous: {samples[-1]}")
+            metrics.reset()
+    finally:
+        widget.start_stop()
+        QtCore.QThreadPool.globalInstance().waitForDone()
+        board.stop()
+    return samples
+
+
+def soak_sweeps(impedance, board, data_logger, sweeps):
+    ui.Params.sweep.update(SWEEP, multiclock=False, repeats=1)
+    widget = ui.SweepWidget(impedance, data_logger)
+    # the sweep runs in the thread pool, wait for it the way the GUI does
+    loop = QtCore.QEventLoop()
+    widget.sweep_done.connect(lambda data: loop.quit())
+    samples, ticks = [], []
+    for i in range(sweeps):
+        t_start = perf_counter()
+        widget.measure()
+        if widget.running:
+            loop.exec_()
+        ticks.append(perf_counter() - t_start)
+        if (i + 1) % SWEEP_WINDOW == 0:
+            samples.append(
+                sample(board.elapsed / 3600, ticks, "ui.sweep_draw", data_logger)
+            )
+            logger.info(f"sweeps: {samples[-1]}")
+            ticks = []
+            metrics.reset()
+    return samples
+
+
+def trends(samples):
+    # growth over the run of a straight line fitted past the warm-up
+    samples = samples[int(len(samples) * WARMUP) :]
+    results = {}
+    for name in TOLERANCES:
+        points = [(s["t"], s[name]) for s in samples if s[name] is not None]
+        if len(points) < 3:
+            continue
+        t, values = np.array(points, dtype=float).T
+        slope, intercept = np.polyfit(t, values, 1)
+        results[name] = (slope * (t[-1] - t[0]), slope * t[0] + intercept)
+    return results
+
+
+def failures(results):
+    failed = []
+    for name, (growth, level) in results.items():
+        relative, absolute = TOLERANCES[name]
+        if growth > relative * abs(level) and growth > absolute:
+            failed.append(name)
+    return failed
+
+
+def render(title, results, failed):
+    lines = [title, f"{'metric':<14}{'initial':>14}{'growth':>14}"]
+    for name, (growth, level) in results.items():
+        verdict = "FAIL" if name in failed else "ok"
+        lines.append(f"{name:<14}{level:>14.4g}{growth:>14.4g}  {verdict}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=float, default=1, help="continuous mode")
+    parser.add_argument("--interval", type=float, default=1, help="seconds per tick")
+    parser.add_argument(
+        "--speedup", type=float, default=SPEEDUP, help="continuous mode"
+    )
+    parser.add_argument(
+        "--draw-interval",
+        type=float,
+        default=DRAW_INTERVAL,
+        help="seconds between continuous plot redraws",
+    )
+    parser.add_argument("--sweeps", type=int, default=2000, help="sweep mode")
+    parser.add_argument("--csv", help="write the sampled metrics to this file")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    # no display needed
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QtWidgets.QApplication(sys.argv)
+    # the soak needs the spans of the GUI paths
+    metrics.enable()
+    # compressed time: a bucket still holds as many ticks as at real time
+    ui.CONTINUOUS_INTERVAL = args.interval / args.speedup
+    export.ROLLUP_RESOLUTIONS = tuple(
+        r / args.speedup for r in export.ROLLUP_RESOLUTIONS
+    )
+    ui.CONTINUOUS_DRAW_INTERVAL = args.draw_interval
+    simulated = SimulatedBoard()
+    simulated.install()
+    board = Board(thermo=None, backend=simulated)
+    impedance = board.impedance
+    impedance.cal_range(RANGE)
+    impedance.range = RANGE
+    all_samples = []
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp:
+        journal = Journal(os.path.join(tmp, "continuous.journal"))
+        data_logger = export.DataLogger(journal)
+        runs = {
+            "continuous": soak_continuous(board, data_logger, args.days, args.interval),
+            "sweep": soak_sweeps(
+                impedance, simulated, export.DataLogger(), args.sweeps
+            ),
+        }
+        journal.close()
+    for mode, samples in runs.items():
+        results = trends(samples)
+        failed += [f"{mode} {name}" for name in failures(results)]
+        print(render(f"{mode} mode", results, failures(results)))
+        print()
+        all_samples += [{"mode": mode, **s} for s in samples]
+    if args.csv and all_samples:
+        with open(args.csv, "w") as fh:
+            writer = csv.DictWriter(fh, fieldnames=list(all_samples[0]))
+            writer.writeheader()
+            writer.writerows(all_samples)
+    if failed:
+        print(f"upward trends: {', '.join(failed)}")
+        sys.exit(1)
@@ -0,0 +1,117 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+import logging
+
+import numpy as np
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# two-sided 95 % confidence
+Z_95 = 1.96
+# sweeps needed before outlier rejection and early stopping kick in
+MIN_SWEEPS = 3
+# median z-score across the sweep above which a sweep is rejected
+OUTLIER_THRESHOLD = 4
+
+
+class RunningStats:
+    # Welford's algorithm, vectorized over the points of a sweep
+    def __init__(self, size):
+        self.count = 0
+        self.rejected = 0
+        self.mean = np.zeros(size)
+        self._m2 = np.zeros(size)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (values - self.mean)
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return np.full_like(self.mean, np.nan)
+        return self._m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def ci(self, z=Z_95):
+        # half-width of the confidence interval of the mean
+        return z * self.std / np.sqrt(max(self.count, 1))
+
+    def is_outlier(self, values, threshold=OUTLIER_THRESHOLD):
+        if self.count < MIN_SWEEPS:
+            return False
+        std = self.std
+        # guard against noise-free points
+        std[std == 0] = np.finfo(float).eps
+        z = np.abs(np.asarray(values, dtype=float) - self.mean) / std
+        return float(np.median(z)) > threshold
+
+
+def average_sweeps(sweep, repeats, target=None):
+    # runs sweep() up to repeats times and yields the running statistics
+    # after every sweep; stops early once the 95 % confidence interval of
+    # |Z| is below target (relative) at every frequency
+    magnitude = phase = None
+    for i in range(repeats):
+        data = sweep()
+        m = [point["magnitude"] for point in data]
+        p = [point["phase"] for point in data]
+        if magnitude is None:
+            freqs = [point["f"] for point in data]
+            magnitude = RunningStats(len(freqs))
+            phase = RunningStats(len(freqs))
+        if magnitude.is_outlier(m) or phase.is_outlier(p):
+            magnitude.rejected += 1
+            logger.debug(f"rejecting sweep {i + 1} as outlier")
+            outlier = True
+        else:
+            magnitude.update(m)
+            phase.update(p)
+            outlier = False
+        converged = (
+            target is not None
+            and magnitude.count >= MIN_SWEEPS
+            and float(np.max(magnitude.ci() / np.abs(magnitude.mean))) < target
+        )
+        yield {
+            "f": freqs,
+            "magnitude": magnitude,
+            "phase": phase,
+            "sweeps": i + 1,
+            "outlier": outlier,
+            "converged": converged,
+        }
+        if converged:
+            logger.debug(f"converged after {i + 1} sweeps")
+            return
+
+
+def to_points(result):
+    magnitude = result["magnitude"]
+    phase = result["phase"]
+    return [
+        {
+            "f": f,
+            "magnitude": m,
+            "phase": p,
+            "magnitude_std": m_std,
+            "phase_std": p_std,
+            "sweeps": magnitude.count,
+        }
+        for f, m, p, m_std, p_std in zip(
+            result["f"],
+            magnitude.mean.tolist(),
+            phase.mean.tolist(),
+            magnitude.std.tolist(),
+            phase.std.tolist(),
+        )
+    ]
@@ -0,0 +1,60 @@
+# SPDX-License-Identifier: GPL-3.0-only
+
+# Copyright (c) 2024 David Schiller <david.schiller@jku.at>
+
+from math import isnan
+
+
+class ChangeTrigger:
+    # decides when a new sample is worth storing: temperature or |Z| moved
+    # by more than a delta since the last stored sample, but no faster than
+    # min_interval and no slower than max_interval
+    def __init__(self, delta_T, delta_Z, min_interval, max_interval):
+        self.delta_T = delta_T
+        # relative change of |Z|
+        self.delta_Z = delta_Z
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.t = self.Z = self.T = None
+
+    def record(self, t, Z, T):
+        self.t, self.Z, self.T = t, Z, T
+
+    def ready(self, t):
+        return self.t is None or t - self.t >= self.min_interval
+
+    def check(self, t, Z=None, T=None):
+        if self.t is None:
+            return True
+        dt = t - self.t
+        if dt < self.min_interval:
+            return False
+        if dt >= self.max_interval:
+            return True
+        if (
+            T is not None
+            and not isnan(T)
+            and (isnan(self.T) or abs(T - self.T) >= self.delta_T)
+        ):
+            return True
+        if Z is not None and abs(Z - self.Z) >= self.delta_Z * abs(self.Z):
+            return True
+        return False
+
+
+class DriftSchedule:
+    # decides when to measure the calibration reference during a run: every
+    # interval or when the board temperature moved by more than delta_T
+    # since the last check, starting with the first sample
+    def __init__(self, interval, delta_T):
+        self.interval = interval
+        self.delta_T = delta_T
+        self.t = self.T = None
+
+    def record(self, t, T):
+        self.t, self.T = t, T
+
+    def due(self, t, T):
+        if self.t is None or t - self.t >= self.interval:
+            return True
+        return abs(T - self.T) >= self.delta_T
@@ -10,7 +10,6 @@ import time
 from queue import Queue
 from textwrap import dedent
 from threading import Timer
-from time import sleep
 from traceback import format_exception
 
 from matplotlib import style
@@ -19,9 +18,17 @@ from matplotlib.backends.backend_qt5agg import FigureCanvas
 from matplotlib.figure import Figure
 from PySide2 import QtCore, QtGui, QtWidgets
 
-from ad5933 import AD5933
-from export import DataLogger
-from mcp9600 import MCP9600
+import metrics
+import qc
+from ad5933 import AD5933, log_spaced, plan_bands
+from boards import Board, BoardWorker, find_boards
+from export import CONTINUOUS, ROLLUP_RESOLUTIONS, DataLogger
+from health import HealthCollector
+from interp import INTERPOLATORS
+from journal import Journal
+from pipeline import SweepPipeline
+from stats import average_sweeps, to_points
+from trigger import ChangeTrigger, DriftSchedule
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -29,22 +36,93 @@ logger = logging.getLogger(__name__)
 BLOCKDEV = "/dev/sda1"
 PLOT_PHASE = True
 PLOT_TEMPERATURE = True
-TCOUPLE_FILTER = 2
 CONTINUOUS_INTERVAL = 1
+# seconds between redraws of the continuous plot, 0 redraws on every sample
+CONTINUOUS_DRAW_INTERVAL = 0
 EXPORT_INDEX = 3
+# ms between refreshes while the Debug or Export tab is shown
+RENDER_INTERVAL = 1000
+# seconds between redraws of a sweep in progress
+PROGRESS_INTERVAL = 1
+# seconds between metrics file updates while tracing
+METRICS_INTERVAL = 10
 
 
 class Params:
     clock = {"rate": None}
-    sweep = {"start": 10000, "increment": 1000, "points": 90}
+    calibration = {"accumulate": False, "adaptive": False}
+    sweep = {
+        "start": 10000,
+        "increment": 1000,
+        "points": 90,
+        "stop": 100000,
+        "multiclock": False,
+        "repeats": 1,
+        # overlap acquisition of the next sweep with processing, see pipeline.py
+        "pipelined": True,
+        # relative 95 % confidence interval of |Z| in percent
+        "target": 0.1,
+    }
+    # event-driven continuous mode, delta_Z in percent, intervals in s
+    trigger = {
+        "enabled": False,
+        "delta_T": 0.5,
+        "delta_Z": 1.0,
+        "min_interval": CONTINUOUS_INTERVAL,
+        "max_interval": 600,
+        "poll": 2,
+    }
+    # pass/fail checks, tolerances in % and °
+    qc = {
+        "magnitude_tolerance": qc.MAGNITUDE_TOLERANCE,
+        "phase_tolerance": qc.PHASE_TOLERANCE,
+        "points": qc.QC_POINTS,
+    }
+    # calibration reference checks in continuous mode, interval in s,
+    # delta_T of the AD5933 die in ℃
+    drift = {"enabled": False, "interval": 900, "delta_T": 1.0}
+
+
+def sweep_freqs(params):
+    # frequencies of a logarithmic multi-clock sweep
+    return log_spaced(
+        params.sweep["start"], params.sweep["stop"], params.sweep["points"] + 1
+    )
+
+
+def calibrate(impedance, params, clock=None):
+    impedance.clock_frequency = params.clock["rate"] if clock is None else clock
+    index = impedance.range
+    accumulate = params.calibration["accumulate"]
+    if not params.calibration["adaptive"]:
+        impedance.cal_range(index, accumulate=accumulate)
+        return
+    # the adaptive grid is searched once per range and clock, then reused
+    grid = impedance.cal_grid(index)
+    if grid is not None:
+        impedance.cal_range(index, accumulate=accumulate, freqs=grid)
+        return
+    impedance.cal_range_adaptive(index, accumulate=accumulate)
+    try:
+        impedance.save_cal_grids()
+    except OSError as e:
+        logger.warning(f"could not save calibration grids: {e}")
 
 
 class SweepWidget(QtWidgets.QWidget):
+    # a sweep in progress owns the device
+    busy = QtCore.Signal(bool)
+    # (points, confidence intervals or None, title) of a sweep in progress
+    sweep_progress = QtCore.Signal(object)
+    # points of the finished sweep, None if it failed
+    sweep_done = QtCore.Signal(object)
+
     def __init__(self, impedance: AD5933, data_logger: DataLogger):
         super().__init__()
         self.impedance = impedance
         self.data_logger = data_logger
         self.params = Params()
+        self.running = False
         style.use("bmh")
         self.figure_canvas = FigureCanvas(Figure(tight_layout=False, dpi=180))
         self.figure_canvas.setStyleSheet("background-color: transparent;")
@@ -88,6 +166,8 @@ class SweepWidget(QtWidgets.QWidget):
         self.cal_button.clicked.connect(self.calibrate)
         self.meas_button.clicked.connect(self.measure)
         self.scale_check.stateChanged.connect(self.toggle_range)
+        self.sweep_progress.connect(self.show_progress)
+        self.sweep_done.connect(self.finish)
 
     @QtCore.Slot()
     def toggle_range(self, value):
@@ -96,28 +176,171 @@ class SweepWidget(QtWidgets.QWidget):
 
     @QtCore.Slot()
     def measure(self):
-        if not self.impedance.gain_parameters[self.impedance.range]:
+        if self.running:
+            # second click stops a sweep in progress
+            self.running = False
+            return
+        if self.params.sweep["multiclock"]:
+            uncalibrated = self.impedance.uncalibrated_bands(sweep_freqs(self.params))
+        elif not self.impedance.gain_parameters[self.impedance.range]:
+            uncalibrated = [self.impedance.clock]
+        else:
+            uncalibrated = []
+        if uncalibrated:
             QtWidgets.QMessageBox.critical(
                 self,
                 "Error",
-                "Selected range is not calibrated.",
+                "Selected range is not calibrated"
+                f" (clock: {', '.join(str(c) for c in uncalibrated)} Hz).",
             )
             logger.warning("not calibrated")
             return
         logger.debug(f"starting sweep: {self.params.sweep}")
-        data = self.impedance.sweep(
+        self.running = True
+        self.busy.emit(True)
+        thread_pool = QtCore.QThreadPool.globalInstance()
+        thread_pool.start(self._Measure(self))
+
+    @QtCore.Slot()
+    def show_progress(self, progress):
+        data, errors, title = progress
+        self.plot(data, errors, title)
+
+    @QtCore.Slot()
+    def finish(self, data):
+        self.running = False
+        self.busy.emit(False)
+        if data:
+            self.data_logger.append_sweep(data)
+            self.plot(data)
+
+    class _Measure(QtCore.QRunnable):
+        # runs the sweep off the GUI thread, partial results are sent to the
+        # widget by signals and drawn there
+        def __init__(self, sweep):
+            super().__init__()
+            self.sweep = sweep
+            self.impedance = sweep.impedance
+            self.params = Params()
+
+        def run(self):
+            logger.debug("starting sweep thread")
+            data = None
+            try:
+                if self.params.sweep["repeats"] > 1:
+                    data = self.measure_repeated()
+                else:
+                    data = self.measure()
+            except Exception:
+                logger.exception("sweep failed")
+            finally:
+                self.sweep.sweep_done.emit(data)
+            logger.debug("stopping sweep thread")
+
+        def measure(self):
+            # draws the sweep progressively as the points come in
+            data = []
+            sweep = self.sweep._iter_sweep()
+            t_draw = time.monotonic()
+            try:
+                for point in sweep:
+                    data.append(point)
+                    if not self.sweep.running:
+                        logger.debug("sweep stopped")
+                        break
+                    if time.monotonic() - t_draw > PROGRESS_INTERVAL:
+                        self.sweep.sweep_progress.emit(
+                            (list(data), None, f"{len(data)} points")
+                        )
+                        t_draw = time.monotonic()
+            finally:
+                sweep.close()
+            logger.debug("sweep finished")
+            return data
+
+        def measure_repeated(self):
+            # a second click on "Measure" stops after the current sweep
+            result = None
+            target = self.params.sweep["target"] / 100
+            if self.params.sweep["pipelined"] and not self.params.sweep["multiclock"]:
+                pipeline = SweepPipeline(
+                    self.impedance,
+                    self.params.sweep["start"],
+                    self.params.sweep["increment"],
+                    self.params.sweep["points"],
+                )
+                sweeps = iter(pipeline)
+                sweep = sweeps.__next__
+            else:
+                pipeline = None
+                sweep = self.sweep._sweep
+            try:
+                for result in average_sweeps(
+                    sweep, self.params.sweep["repeats"], target
+                ):
+                    magnitude = result["magnitude"]
+                    title = (
+                        f"{magnitude.count} sweeps averaged"
+                        f", {magnitude.rejected} rejected"
+                        + (", converged" if result["converged"] else "")
+                    )
+                    if pipeline is not None:
+                        title += (
+                            f"\n{pipeline.throughput:.1f} sweeps/min"
+                            f", hardware duty cycle {pipeline.duty_cycle * 100:.0f} %"
+                        )
+                    self.sweep.sweep_progress.emit(
+                        (
+                            to_points(result),
+                            (magnitude.ci(), result["phase"].ci()),
+                            title,
+                        )
+                    )
+                    if not self.sweep.running:
+                        logger.debug("repeated sweep stopped")
+                        break
+            finally:
+                if pipeline is not None:
+                    sweeps.close()
+            if result is None:
+                return None
+            logger.debug(f"repeated sweep finished after {result['sweeps']} sweeps")
+            return to_points(result)
+
+    def _sweep(self):
+        with metrics.span("ui.sweep"):
+            return list(self._iter_sweep())
+
+    def _iter_sweep(self):
+        if self.params.sweep["multiclock"]:
+            return self.impedance.iter_sweep_bands(sweep_freqs(self.params))
+        return self.impedance.iter_sweep(
             self.params.sweep["start"],
             self.params.sweep["increment"],
             self.params.sweep["points"],
         )
-        logger.debug("sweep finished")
-        self.data_logger.append_sweep(data)
+
+    def plot(self, data, errors=None, title=None):
+        f = [i["f"] for i in data]
+        magnitude = [i["magnitude"] for i in data]
+        phase = [i["phase"] for i in data]
         fig = self.figure_canvas.figure
         fig.clear()
+        if title:
+            fig.suptitle(title, fontsize="small")
         ax = fig.subplots()
-        ax.plot([i["f"] for i in data], [i["magnitude"] for i in data], label="|Z|")
+        ax.plot(f, magnitude, label="|Z|")
+        if errors is not None and len(data) == len(errors[0]):
+            ax.fill_between(
+                f,
+                [m - e for m, e in zip(magnitude, errors[0])],
+                [m + e for m, e in zip(magnitude, errors[0])],
+                color="C0",
+                alpha=0.3,
+                linewidth=0,
+            )
         ax.set_xlabel("f / Hz", labelpad=0, fontsize="medium")
-        ax.set_ylabel("|Z| / Ω", labelpad=0, fontsize="medium")
+        ax.set_ylabel("|Z| / Ω", labelpad=0, fontsize="medium")
         ax.set_xscale("log")
         ax.margins(y=1)
         ax.set_ylim(bottom=0, auto=True)
@@ -136,32 +359,57 @@ class SweepWidget(QtWidgets.QWidget):
             ax2 = ax.twinx()
             ax2.grid(visible=False)
             ax2.set_ylabel("φ / °")
-            ax2.plot(
-                [i["f"] for i in data],
-                [i["phase"] for i in data],
-                label="φ",
-                color="C1",
-            )
+            ax2.plot(f, phase, label="φ", color="C1")
+            if errors is not None and len(data) == len(errors[1]):
+                ax2.fill_between(
+                    f,
+                    [p - e for p, e in zip(phase, errors[1])],
+                    [p + e for p, e in zip(phase, errors[1])],
+                    color="C1",
+                    alpha=0.3,
+                    linewidth=0,
+                )
             fig.legend(**legend_args)
         else:
             ax.legend()
 
-        self.figure_canvas.draw()
+        with metrics.span("ui.sweep_draw"):
+            self.figure_canvas.draw()
 
     @QtCore.Slot()
     def calibrate(self):
         logger.debug("starting calibration")
-        self.impedance.clock_frequency = self.params.clock["rate"]
-        self.impedance.cal_range(self.impedance.range)
+        if self.params.sweep["multiclock"]:
+            # one calibration per clock the sweep needs
+            for clock, _ in plan_bands(sweep_freqs(self.params)):
+                logger.debug(f"calibrating band at {clock} Hz")
+                calibrate(self.impedance, self.params, clock)
+            self.impedance.use_clock(self.params.clock["rate"])
+        else:
+            calibrate(self.impedance, self.params)
         logger.debug("calibration finished")
 
+    def closeEvent(self, event):
+        self.running = False
+        event.accept()
+
 
 class ContinuousWidget(QtWidgets.QWidget):
-    def __init__(self, impedance: AD5933, thermo: MCP9600, data_logger: DataLogger):
+    def __init__(
+        self,
+        impedance: AD5933,
+        board: Board,
+        data_logger: DataLogger,
+        boards=(),
+    ):
         super().__init__()
         self.impedance = impedance
-        self.thermo = thermo
+        # thermocouple readings of the interactive board, if it has one
+        self.board = board
         self.data_logger = data_logger
+        # further boards measured in parallel to this one
+        self.boards = boards
+        self.workers = []
         self.params = Params()
         self.running = False
         style.use("bmh")
@@ -187,6 +435,9 @@ class ContinuousWidget(QtWidgets.QWidget):
         self.ymax_box = QtWidgets.QSpinBox()
         self.ymax_box.setEnabled(False)
         self.ymax_box.setRange(0, 2 ** 31 - 1)
+        self.boards_check = QtWidgets.QCheckBox(f"All {len(boards) + 1} boards")
+        self.boards_check.setChecked(True)
+        self.boards_check.setVisible(bool(boards))
 
         self.vbox = QtWidgets.QVBoxLayout()
         self.check_hbox = QtWidgets.QHBoxLayout()
@@ -196,6 +447,7 @@ class ContinuousWidget(QtWidgets.QWidget):
         self.check_hbox.addWidget(self.ymin_box)
         self.check_hbox.addWidget(self.ymax_text)
         self.check_hbox.addWidget(self.ymax_box)
+        self.check_hbox.addWidget(self.boards_check)
         self.hbox = QtWidgets.QHBoxLayout()
         self.hbox.addWidget(self.cal_button)
         self.hbox.addWidget(self.start_button)
@@ -221,27 +473,52 @@ class ContinuousWidget(QtWidgets.QWidget):
             self.continuous = continuous
             self.figure_canvas = continuous.figure_canvas
             self.impedance = continuous.impedance
-            self.thermo = continuous.thermo
+            self.board = continuous.board
             self.data_logger = continuous.data_logger
+            self.workers = continuous.workers
             self.params = Params()
 
         def run(self):
             logger.debug("starting measurement thread")
             queue = Queue()
             t0 = time.monotonic()
-            t, Z, phi, T = [], [], [], []
+            f = self.params.sweep["start"]
+            # absolute time, |Z| and T of the latest sample
+            last = None
+            t_drawn = None
+            series = self.data_logger.start_continuous()
+            # tag samples when other boards are logging alongside
+            tag = {"device": self.impedance.dev.id} if self.continuous.workers else {}
 
             def redraw(Z_line, T_artist):
-                t_, Z_, phi_, T_ = queue.get(timeout=30)
-                t.append(t_)
-                Z.append(Z_)
-                T.append(T_)
-                phi.append(phi_)
-                Z_line.set_data([(t - t0) / 60 for t in t], Z)
+                nonlocal last, series, t_drawn
+                t_, Z_, phi_, T_, extra = queue.get(timeout=30)
+                last = (t_, Z_, T_)
+                series = self.data_logger.append_continuous_point(
+                    {
+                        "f": f,
+                        "t": round(t_ - t0, 3),
+                        "magnitude": Z_,
+                        "phase": phi_,
+                        "T": T_,
+                        **tag,
+                        **extra,
+                    },
+                    series,
+                )
+                t_now = time.monotonic()
+                if t_drawn is not None and t_now - t_drawn < CONTINUOUS_DRAW_INTERVAL:
+                    return
+                t_drawn = t_now
+                # long runs are drawn from the logger's rollups
+                pixels = max(1, int(self.ax.bbox.width))
+                t, Z, _, _ = self.data_logger.overview("magnitude", pixels, series)
+                Z_line.set_data([t / 60 for t in t], Z)
                 self.ax.relim()
                 self.ax.autoscale_view()
                 if PLOT_TEMPERATURE:
-                    T_artist.set_data([(t - t0) / 60 for t in t], T)
+                    t, T, _, _ = self.data_logger.overview("T", pixels, series)
+                    T_artist.set_data([t / 60 for t in t], T)
                     self.ax2.relim()
                     self.ax2.autoscale_view()
                 else:
@@ -249,17 +526,28 @@ class ContinuousWidget(QtWidgets.QWidget):
                         f"T = {T_:6.2f} ℃",
                     )
                 try:
-                    self.figure_canvas.draw()
+                    with metrics.span("ui.continuous_draw"):
+                        self.figure_canvas.draw()
                 except RuntimeError:
                     # suppress the following on SIGINT:
                     # "Internal C++ object (FigureCanvasQTAgg) already deleted."
                     pass
 
             def acquire():
-                t = time.monotonic()
-                T = self.thermo.temp
-                magnitude, phase = self.impedance.measure(self.params.sweep["start"])
-                queue.put((t, magnitude, phase, T), timeout=5)
+                # a reference check leaves a gap before the sample it flags
+                extra = {}
+                if drift is not None:
+                    T_board = self.impedance.temp
+                    extra["drift"] = None
+                    if drift.due(time.monotonic(), T_board):
+                        _, ratio, _ = self.impedance.check_drift(f)
+                        drift.record(time.monotonic(), T_board)
+                        extra["drift"] = (ratio - 1) * 100
+                t_start = time.monotonic()
+                with metrics.span("ui.acquire"):
+                    magnitude, phase = self.impedance.measure(f)
+                t = (t_start + time.monotonic()) / 2
+                queue.put((t, magnitude, phase, self.board.temp_at(t), extra), timeout=5)
 
             (Z_line,) = self.ax.plot((), label="|Z|", color="C0")
             if PLOT_TEMPERATURE:
@@ -270,28 +558,70 @@ class ContinuousWidget(QtWidgets.QWidget):
                     "",
                     transform=self.ax.transAxes,
                 )
+            if self.params.trigger["enabled"]:
+                trigger = ChangeTrigger(
+                    self.params.trigger["delta_T"],
+                    self.params.trigger["delta_Z"] / 100,
+                    self.params.trigger["min_interval"],
+                    self.params.trigger["max_interval"],
+                )
+            else:
+                trigger = None
+            drift = self.continuous.drift_schedule()
             # first acquiration
             acquire()
             redraw(Z_line, T_artist)
             while self.continuous.running:
+                if trigger is not None:
+                    trigger.record(*last)
+                    if self.wait_for_trigger(trigger):
+                        acquire()
+                        redraw(Z_line, T_artist)
+                    continue
                 # schedule another acquiration in t_remaining
-                t_remaining = max(0, t[-1] + CONTINUOUS_INTERVAL - time.monotonic())
+                t_remaining = last[0] + CONTINUOUS_INTERVAL - time.monotonic()
+                if t_remaining < 0:
+                    metrics.count("continuous.missed_ticks")
+                t_remaining = max(0, t_remaining)
                 Timer(t_remaining, acquire).start()
                 redraw(Z_line, T_artist)
-            self.data_logger.append_continuous(
-                [
-                    {
-                        "f": self.params.sweep["start"],
-                        "t": round(t - t0, 3),
-                        "magnitude": Z,
-                        "phase": phi,
-                        "T": T,
-                    }
-                    for t, Z, phi, T in zip(t, Z, phi, T)
-                ]
-            )
+            # the other boards append until they are stopped too
+            for worker in self.workers:
+                if worker.is_alive():
+                    worker.join()
+            self.data_logger.complete()
             logger.debug("stopping measurement thread")
 
+        def wait_for_trigger(self, trigger):
+            # polls the thermocouple buffer and a cheap single-DFT probe of
+            # |Z| until the trigger fires, returns False when stopped
+            f = self.params.sweep["start"]
+            while self.continuous.running:
+                t_poll = time.monotonic()
+                if trigger.ready(t_poll):
+                    T = self.board.temp_at(t_poll)
+                    if trigger.check(t_poll, T=T):
+                        return True
+                    magnitude, _ = self.impedance.measure(f, samples=0)
+                    metrics.count("trigger.probes")
+                    if trigger.check(time.monotonic(), Z=magnitude):
+                        return True
+                    interval = self.params.trigger["poll"]
+                else:
+                    interval = trigger.t + trigger.min_interval - t_poll
+                # sleep in short slices to react to stop requests
+                t_end = t_poll + interval
+                while self.continuous.running and time.monotonic() < t_end:
+                    time.sleep(min(0.1, max(0, t_end - time.monotonic())))
+            return False
+
+    def drift_schedule(self):
+        if not self.params.drift["enabled"]:
+            return None
+        return DriftSchedule(
+            self.params.drift["interval"], self.params.drift["delta_T"]
+        )
+
     @QtCore.Slot()
     def start_stop(self):
         if not self.impedance.gain_parameters[self.impedance.range]:
@@ -326,24 +656,42 @@ class ContinuousWidget(QtWidgets.QWidget):
                 ax.set_yscale("log")
             if not self.scale_check.checkState():
                 ax.set_ylim(self.ymin_box.value(), self.ymax_box.value())
+            if self.boards_check.isChecked():
+                self.workers = [
+                    BoardWorker(
+                        board,
+                        self.data_logger,
+                        self.params.sweep["start"],
+                        CONTINUOUS_INTERVAL,
+                        self.impedance.range,
+                        self.drift_schedule(),
+                    )
+                    for board in self.boards
+                ]
             thread_pool = QtCore.QThreadPool.globalInstance()
             runnable = self._Measure(self, ax, ax2)
             thread_pool.start(runnable)
             self.running = True
+            for worker in self.workers:
+                worker.start()
 
         else:
             logger.debug("stopping continuous measurement")
             self.running = False
+            for worker in self.workers:
+                worker.stop()
+            self.workers = []
 
     @QtCore.Slot()
     def calibrate(self):
         logger.debug("starting calibration")
-        self.impedance.clock_frequency = self.params.clock["rate"]
-        self.impedance.cal_range(self.impedance.range)
+        calibrate(self.impedance, self.params)
         logger.debug("calibration finished")
 
     def closeEvent(self, event):
         self.running = False
+        for worker in self.workers:
+            worker.stop()
         event.accept()
 
 
@@ -358,6 +706,22 @@ class RangeWidget(QtWidgets.QWidget):
         self.clock_text = QtWidgets.QLabel("Clock frequency (takes effect upon next calibration):")
         self.clock_box = QtWidgets.QSpinBox()
         self.clock_box.setRange(22500, 9e6)
+        self.temp_text = QtWidgets.QLabel(
+            "Keep calibrations from other board temperatures:"
+        )
+        self.temp_check = QtWidgets.QCheckBox()
+        self.temp_check.setChecked(self.params.calibration["accumulate"])
+        self.adaptive_text = QtWidgets.QLabel("Adaptive calibration grid:")
+        self.adaptive_check = QtWidgets.QCheckBox()
+        self.adaptive_check.setChecked(self.params.calibration["adaptive"])
+        self.forget_button = QtWidgets.QPushButton("Forget adaptive grids")
+        self.verify_button = QtWidgets.QPushButton(
+            "Verify calibration (re-measures only drifted regions)"
+        )
+        self.interpolation_text = QtWidgets.QLabel("Calibration interpolation:")
+        self.interpolation_dropdown = QtWidgets.QComboBox()
+        self.interpolation_dropdown.addItems(list(INTERPOLATORS))
+        self.interpolation_dropdown.setCurrentText(self.impedance.interpolation)
         self.range_description = QtWidgets.QLabel(
             dedent(
                 """\
@@ -376,7 +740,14 @@ class RangeWidget(QtWidgets.QWidget):
         self.form_layout = QtWidgets.QFormLayout()
         self.form_layout.addRow(self.range_text, self.range_dropdown)
         self.form_layout.addRow(self.clock_text, self.clock_box)
+        self.form_layout.addRow(self.temp_text, self.temp_check)
+        self.adaptive_hbox = QtWidgets.QHBoxLayout()
+        self.adaptive_hbox.addWidget(self.adaptive_check)
+        self.adaptive_hbox.addWidget(self.forget_button)
+        self.form_layout.addRow(self.adaptive_text, self.adaptive_hbox)
+        self.form_layout.addRow(self.interpolation_text, self.interpolation_dropdown)
         self.layout.addLayout(self.form_layout)
+        self.layout.addWidget(self.verify_button)
         self.layout.addWidget(self.range_description)
         self.setLayout(self.layout)
 
@@ -384,6 +755,11 @@ class RangeWidget(QtWidgets.QWidget):
         self.clock_box.setValue(self.params.clock["rate"])
         self.range_dropdown.textActivated.connect(self.select_range)
         self.clock_box.valueChanged.connect(self.set_clock)
+        self.temp_check.stateChanged.connect(self.set_accumulate)
+        self.adaptive_check.stateChanged.connect(self.set_adaptive)
+        self.forget_button.clicked.connect(self.forget_grids)
+        self.verify_button.clicked.connect(self.verify)
+        self.interpolation_dropdown.textActivated.connect(self.set_interpolation)
 
     @QtCore.Slot()
     def select_range(self, range_no):
@@ -395,6 +771,52 @@ class RangeWidget(QtWidgets.QWidget):
         self.params.clock["rate"] = clock
         logger.debug(f"set clock to {clock}")
 
+    @QtCore.Slot()
+    def set_accumulate(self, value):
+        self.params.calibration["accumulate"] = bool(value)
+        logger.debug(f"accumulate calibrations: {bool(value)}")
+
+    @QtCore.Slot()
+    def set_adaptive(self, value):
+        self.params.calibration["adaptive"] = bool(value)
+        logger.debug(f"adaptive calibration: {bool(value)}")
+
+    @QtCore.Slot()
+    def set_interpolation(self, name):
+        self.impedance.interpolation = name
+        logger.debug(f"calibration interpolation: {name}")
+
+    @QtCore.Slot()
+    def verify(self):
+        # calibrations on record for the configured clock, if any
+        self.impedance.use_clock(self.params.clock["rate"])
+        t_start = time.monotonic()
+        result = self.impedance.verify_range(
+            self.impedance.range, accumulate=self.params.calibration["accumulate"]
+        )
+        logger.debug(f"calibration verified: {result}")
+        if not result["checked"]:
+            text = "Range was not calibrated, ran a full calibration."
+        elif not result["drifted"]:
+            text = f"Calibration OK at all {result['checked']} checked frequencies."
+        else:
+            text = (
+                f"{len(result['drifted'])} of {result['checked']} checked frequencies "
+                f"drifted, re-measured {result['measured']} calibration points."
+            )
+        QtWidgets.QMessageBox.information(
+            self, "Calibration", f"{text}\n({time.monotonic() - t_start:.1f} s)"
+        )
+
+    @QtCore.Slot()
+    def forget_grids(self):
+        self.impedance.cal_grids.clear()
+        try:
+            self.impedance.save_cal_grids()
+        except OSError as e:
+            logger.warning(f"could not save calibration grids: {e}")
+        logger.debug("cleared adaptive calibration grids")
+
     @QtCore.Slot()
     def update(self, index):
         self.range_dropdown.setCurrentIndex = self.impedance.range - 1
@@ -414,20 +836,55 @@ class SweepSettingsWidget(QtWidgets.QWidget):
         self.points_text = QtWidgets.QLabel("Number of points in sweep:")
         self.points_box = QtWidgets.QSpinBox()
         self.points_box.setRange(1, 511)
+        self.multiclock_text = QtWidgets.QLabel(
+            "Logarithmic sweep across clock bands (ignores increment):"
+        )
+        self.multiclock_check = QtWidgets.QCheckBox()
+        self.stop_text = QtWidgets.QLabel("Stop frequency (Hz, logarithmic sweep):")
+        self.stop_box = QtWidgets.QSpinBox()
+        self.stop_box.setRange(1, 100000)
+        self.stop_box.setEnabled(False)
+        self.repeats_text = QtWidgets.QLabel("Repeated sweeps to average (max.):")
+        self.repeats_box = QtWidgets.QSpinBox()
+        self.repeats_box.setRange(1, 1000)
+        self.pipelined_text = QtWidgets.QLabel(
+            "Acquire next sweep while processing (repeated linear sweeps):"
+        )
+        self.pipelined_check = QtWidgets.QCheckBox()
+        self.target_text = QtWidgets.QLabel("Target confidence interval (%):")
+        self.target_box = QtWidgets.QDoubleSpinBox()
+        self.target_box.setRange(0, 100)
+        self.target_box.setDecimals(3)
+        self.target_box.setSingleStep(0.01)
 
         self.layout = QtWidgets.QFormLayout()
         self.layout.addRow(self.start_text, self.start_box)
         self.layout.addRow(self.increment_text, self.increment_box)
         self.layout.addRow(self.points_text, self.points_box)
+        self.layout.addRow(self.multiclock_text, self.multiclock_check)
+        self.layout.addRow(self.stop_text, self.stop_box)
+        self.layout.addRow(self.repeats_text, self.repeats_box)
+        self.layout.addRow(self.pipelined_text, self.pipelined_check)
+        self.layout.addRow(self.target_text, self.target_box)
 
         self.setLayout(self.layout)
 
         self.start_box.setValue(self.params.sweep["start"])
         self.increment_box.setValue(self.params.sweep["increment"])
         self.points_box.setValue(self.params.sweep["points"])
+        self.stop_box.setValue(self.params.sweep["stop"])
+        self.multiclock_check.setChecked(self.params.sweep["multiclock"])
+        self.repeats_box.setValue(self.params.sweep["repeats"])
+        self.pipelined_check.setChecked(self.params.sweep["pipelined"])
+        self.target_box.setValue(self.params.sweep["target"])
         self.start_box.valueChanged.connect(self.set_start)
         self.increment_box.valueChanged.connect(self.set_increment)
         self.points_box.valueChanged.connect(self.set_points)
+        self.stop_box.valueChanged.connect(self.set_stop)
+        self.multiclock_check.stateChanged.connect(self.set_multiclock)
+        self.repeats_box.valueChanged.connect(self.set_repeats)
+        self.pipelined_check.stateChanged.connect(self.set_pipelined)
+        self.target_box.valueChanged.connect(self.set_target)
 
     @QtCore.Slot()
     def set_start(self, value):
@@ -441,6 +898,141 @@ class SweepSettingsWidget(QtWidgets.QWidget):
     def set_points(self, value):
         self.params.sweep["points"] = value
 
+    @QtCore.Slot()
+    def set_stop(self, value):
+        self.params.sweep["stop"] = value
+
+    @QtCore.Slot()
+    def set_multiclock(self, value):
+        self.params.sweep["multiclock"] = bool(value)
+        self.stop_box.setEnabled(bool(value))
+        self.increment_box.setEnabled(not value)
+
+    @QtCore.Slot()
+    def set_repeats(self, value):
+        self.params.sweep["repeats"] = value
+
+    @QtCore.Slot()
+    def set_pipelined(self, value):
+        self.params.sweep["pipelined"] = bool(value)
+
+    @QtCore.Slot()
+    def set_target(self, value):
+        self.params.sweep["target"] = value
+
+
+class TriggerSettingsWidget(QtWidgets.QWidget):
+    def __init__(self):
+        super().__init__()
+        self.params = Params()
+        self.enabled_text = QtWidgets.QLabel("Only store samples on change:")
+        self.enabled_check = QtWidgets.QCheckBox()
+        self.delta_T_text = QtWidgets.QLabel("Temperature change (℃):")
+        self.delta_T_box = QtWidgets.QDoubleSpinBox()
+        self.delta_T_box.setRange(0.01, 100)
+        self.delta_T_box.setSingleStep(0.1)
+        self.delta_Z_text = QtWidgets.QLabel("|Z| change (%):")
+        self.delta_Z_box = QtWidgets.QDoubleSpinBox()
+        self.delta_Z_box.setRange(0.01, 100)
+        self.delta_Z_box.setSingleStep(0.1)
+        self.min_interval_text = QtWidgets.QLabel("Minimum interval (s):")
+        self.min_interval_box = QtWidgets.QSpinBox()
+        self.min_interval_box.setRange(1, 86400)
+        self.max_interval_text = QtWidgets.QLabel("Maximum interval (s):")
+        self.max_interval_box = QtWidgets.QSpinBox()
+        self.max_interval_box.setRange(1, 86400)
+        self.poll_text = QtWidgets.QLabel("|Z| probe interval (s):")
+        self.poll_box = QtWidgets.QSpinBox()
+        self.poll_box.setRange(1, 3600)
+
+        self.layout = QtWidgets.QFormLayout()
+        self.layout.addRow(self.enabled_text, self.enabled_check)
+        self.layout.addRow(self.delta_T_text, self.delta_T_box)
+        self.layout.addRow(self.delta_Z_text, self.delta_Z_box)
+        self.layout.addRow(self.min_interval_text, self.min_interval_box)
+        self.layout.addRow(self.max_interval_text, self.max_interval_box)
+        self.layout.addRow(self.poll_text, self.poll_box)
+
+        self.setLayout(self.layout)
+
+        self.enabled_check.setChecked(self.params.trigger["enabled"])
+        self.delta_T_box.setValue(self.params.trigger["delta_T"])
+        self.delta_Z_box.setValue(self.params.trigger["delta_Z"])
+        self.min_interval_box.setValue(self.params.trigger["min_interval"])
+        self.max_interval_box.setValue(self.params.trigger["max_interval"])
+        self.poll_box.setValue(self.params.trigger["poll"])
+        self.enabled_check.stateChanged.connect(self.set_enabled)
+        self.delta_T_box.valueChanged.connect(self.set_delta_T)
+        self.delta_Z_box.valueChanged.connect(self.set_delta_Z)
+        self.min_interval_box.valueChanged.connect(self.set_min_interval)
+        self.max_interval_box.valueChanged.connect(self.set_max_interval)
+        self.poll_box.valueChanged.connect(self.set_poll)
+
+    @QtCore.Slot()
+    def set_enabled(self, value):
+        self.params.trigger["enabled"] = bool(value)
+
+    @QtCore.Slot()
+    def set_delta_T(self, value):
+        self.params.trigger["delta_T"] = value
+
+    @QtCore.Slot()
+    def set_delta_Z(self, value):
+        self.params.trigger["delta_Z"] = value
+
+    @QtCore.Slot()
+    def set_min_interval(self, value):
+        self.params.trigger["min_interval"] = value
+
+    @QtCore.Slot()
+    def set_max_interval(self, value):
+        self.params.trigger["max_interval"] = value
+
+    @QtCore.Slot()
+    def set_poll(self, value):
+        self.params.trigger["poll"] = value
+
+
+class DriftSettingsWidget(QtWidgets.QWidget):
+    def __init__(self):
+        super().__init__()
+        self.params = Params()
+        self.enabled_text = QtWidgets.QLabel("Check calibration reference:")
+        self.enabled_check = QtWidgets.QCheckBox()
+        self.interval_text = QtWidgets.QLabel("Check interval (s):")
+        self.interval_box = QtWidgets.QSpinBox()
+        self.interval_box.setRange(10, 86400)
+        self.delta_T_text = QtWidgets.QLabel("Board temperature change (℃):")
+        self.delta_T_box = QtWidgets.QDoubleSpinBox()
+        self.delta_T_box.setRange(0.1, 100)
+        self.delta_T_box.setSingleStep(0.1)
+
+        self.layout = QtWidgets.QFormLayout()
+        self.layout.addRow(self.enabled_text, self.enabled_check)
+        self.layout.addRow(self.interval_text, self.interval_box)
+        self.layout.addRow(self.delta_T_text, self.delta_T_box)
+
+        self.setLayout(self.layout)
+
+        self.enabled_check.setChecked(self.params.drift["enabled"])
+        self.interval_box.setValue(self.params.drift["interval"])
+        self.delta_T_box.setValue(self.params.drift["delta_T"])
+        self.enabled_check.stateChanged.connect(self.set_enabled)
+        self.interval_box.valueChanged.connect(self.set_interval)
+        self.delta_T_box.valueChanged.connect(self.set_delta_T)
+
+    @QtCore.Slot()
+    def set_enabled(self, value):
+        self.params.drift["enabled"] = bool(value)
+
+    @QtCore.Slot()
+    def set_interval(self, value):
+        self.params.drift["interval"] = value
+
+    @QtCore.Slot()
+    def set_delta_T(self, value):
+        self.params.drift["delta_T"] = value
+
 
 class SetupWidget(QtWidgets.QWidget):
     def __init__(self, impedance: AD5933):
@@ -450,14 +1042,22 @@ class SetupWidget(QtWidgets.QWidget):
         self.sweep_group = QtWidgets.QGroupBox(
             "Sweep settings (start frequency also applies to continuous mode)"
         )
+        self.trigger_group = QtWidgets.QGroupBox("Continuous mode event trigger")
+        self.drift_group = QtWidgets.QGroupBox("Continuous mode drift check")
         self.range_widget = RangeWidget(impedance)
         self.sweep_widget = SweepSettingsWidget(impedance)
+        self.trigger_widget = TriggerSettingsWidget()
+        self.drift_widget = DriftSettingsWidget()
 
         self.vbox = QtWidgets.QVBoxLayout()
         self.range_group.setLayout(self.range_widget.layout)
         self.sweep_group.setLayout(self.sweep_widget.layout)
+        self.trigger_group.setLayout(self.trigger_widget.layout)
+        self.drift_group.setLayout(self.drift_widget.layout)
         self.vbox.addWidget(self.range_group)
         self.vbox.addWidget(self.sweep_group)
+        self.vbox.addWidget(self.trigger_group)
+        self.vbox.addWidget(self.drift_group)
         self.setLayout(self.vbox)
 
 
@@ -476,21 +1076,80 @@ class CustomFileDialog(QtWidgets.QFileDialog):
             return self.selectedFiles()[0]
 
 
+class DataLoggerModel(QtCore.QAbstractTableModel):
+    # rows are formatted only when the view asks for them
+    def __init__(self, data_logger: DataLogger):
+        super().__init__()
+        self.data_logger = data_logger
+        self.fields = ()
+        self.rows = 0
+
+    def refresh(self):
+        fields = self.data_logger.fields()
+        rows = self.data_logger.points
+        if fields != self.fields or rows < self.rows:
+            self.beginResetModel()
+            self.fields = fields
+            self.rows = rows
+            self.endResetModel()
+        elif rows > self.rows:
+            self.beginInsertRows(QtCore.QModelIndex(), self.rows, rows - 1)
+            self.rows = rows
+            self.endInsertRows()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self.rows
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.fields)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole or not index.isValid():
+            return None
+        try:
+            point = self.data_logger.row(index.row())
+        except IndexError:
+            # cleared since the last refresh
+            return None
+        return str(point.get(self.fields[index.column()], ""))
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.fields[section]
+        return None
+
+
 class ExportWidget(QtWidgets.QWidget):
     def __init__(self, impedance: AD5933, data_logger: DataLogger):
         super().__init__()
         self.impedance = impedance
         self.data_logger = data_logger
-        self.preview_box = QtWidgets.QTextEdit()
-        self.preview_box.setReadOnly(True)
+        self.model = DataLoggerModel(data_logger)
+        self.preview_box = QtWidgets.QTableView()
+        self.preview_box.setModel(self.model)
+        self.preview_box.verticalHeader().setVisible(False)
+        self.preview_box.setVerticalScrollMode(
+            QtWidgets.QAbstractItemView.ScrollPerPixel
+        )
+        self.preview_box.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
         try:
             if os.environ["QT_QPA_PLATFORM"] == "eglfs":
-                self.preview_box.setTextInteractionFlags(QtCore.Qt.NoTextInteraction)
+                self.preview_box.setSelectionMode(
+                    QtWidgets.QAbstractItemView.NoSelection
+                )
                 self.preview_box.setFont(QtGui.QFont("monospace", 6))
             else:
                 self.preview_box.setFont(QtGui.QFont("monospace"))
         except KeyError:
             self.preview_box.setFont(QtGui.QFont("monospace"))
+        # fixed row heights keep scrolling independent of the number of rows
+        rows = self.preview_box.verticalHeader()
+        rows.setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
+        rows.setDefaultSectionSize(self.preview_box.fontMetrics().height() + 4)
+        # kinetic scrolling by dragging on the touchscreen
+        QtWidgets.QScroller.grabGesture(
+            self.preview_box.viewport(), QtWidgets.QScroller.LeftMouseButtonGesture
+        )
 
         self.clear_button = QtWidgets.QPushButton("Clear measurements")
         self.file_button = QtWidgets.QPushButton(
@@ -506,11 +1165,20 @@ class ExportWidget(QtWidgets.QWidget):
         self.file_picker.setDefaultSuffix("csv")
         self.file_picker.setAcceptMode(QtWidgets.QFileDialog.AcceptSave)
         self.file_picker.setVisible(False)
+        self.summary_text = QtWidgets.QLabel("Continuous export resolution:")
+        self.summary_box = QtWidgets.QComboBox()
+        self.summary_box.addItem("All samples", None)
+        for resolution in ROLLUP_RESOLUTIONS:
+            self.summary_box.addItem(f"{resolution} s min/mean/max", resolution)
 
         self.vbox = QtWidgets.QVBoxLayout()
+        self.summary_hbox = QtWidgets.QHBoxLayout()
+        self.summary_hbox.addWidget(self.summary_text)
+        self.summary_hbox.addWidget(self.summary_box)
         self.vbox.addWidget(self.clear_button)
         self.vbox.addWidget(self.preview_box)
         self.vbox.addWidget(self.file_picker)
+        self.vbox.addLayout(self.summary_hbox)
         self.vbox.addWidget(self.file_button)
         self.vbox.addWidget(self.mount_button)
         self.setLayout(self.vbox)
@@ -519,12 +1187,18 @@ class ExportWidget(QtWidgets.QWidget):
         self.file_button.clicked.connect(self.show_hide_dialog)
         self.mount_button.clicked.connect(self.mount_unmount)
         self.file_picker.fileSelected.connect(self.save)
+        # picks up samples logged while the preview is shown
+        self.refresh_timer = QtCore.QTimer()
+        self.refresh_timer.timeout.connect(self.model.refresh)
 
     @QtCore.Slot()
     def update(self, index):
         # TODO: make this more elegant
         if index == EXPORT_INDEX:
-            self.preview_box.setText(self.data_logger.export_to_string())
+            self.model.refresh()
+            self.refresh_timer.start(RENDER_INTERVAL)
+        else:
+            self.refresh_timer.stop()
 
     @QtCore.Slot()
     def clear_measurements(self):
@@ -568,14 +1242,168 @@ class ExportWidget(QtWidgets.QWidget):
     @QtCore.Slot()
     def save(self, filename):
         logger.debug(f"exporting to {filename}")
-        self.data_logger.export_to_file(filename)
+        resolution = self.summary_box.currentData()
+        if resolution is not None and self.data_logger.mode == CONTINUOUS:
+            self.data_logger.export_summary(filename, resolution)
+        else:
+            self.data_logger.export_to_file(filename)
         self.show_hide_dialog()
 
 
-class DebugWidget(QtWidgets.QWidget):
+class QCWidget(QtWidgets.QWidget):
     def __init__(self, impedance: AD5933):
         super().__init__()
         self.impedance = impedance
+        self.params = Params()
+        try:
+            self.reference = qc.Reference.load()
+        except FileNotFoundError:
+            self.reference = None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"ignoring unreadable QC reference: {e}")
+            self.reference = None
+        self.results_log = qc.ResultsLog()
+        self.passed = self.failed = 0
+        self.reference_text = QtWidgets.QLabel()
+        self.verdict_text = QtWidgets.QLabel("-")
+        self.verdict_text.setAlignment(QtCore.Qt.AlignCenter)
+        font = self.verdict_text.font()
+        font.setPointSize(font.pointSize() * 4)
+        font.setBold(True)
+        self.verdict_text.setFont(font)
+        self.detail_text = QtWidgets.QLabel()
+        self.detail_text.setAlignment(QtCore.Qt.AlignCenter)
+        self.magnitude_text = QtWidgets.QLabel("|Z| tolerance (%):")
+        self.magnitude_box = QtWidgets.QDoubleSpinBox()
+        self.magnitude_box.setRange(0.01, 100)
+        self.magnitude_box.setSingleStep(0.1)
+        self.phase_text = QtWidgets.QLabel("Phase tolerance (°):")
+        self.phase_box = QtWidgets.QDoubleSpinBox()
+        self.phase_box.setRange(0.01, 90)
+        self.phase_box.setSingleStep(0.1)
+        self.points_text = QtWidgets.QLabel("Max. frequencies checked:")
+        self.points_box = QtWidgets.QSpinBox()
+        self.points_box.setRange(1, 511)
+        self.record_button = QtWidgets.QPushButton("Record reference (golden part)")
+        self.check_button = QtWidgets.QPushButton("Check part")
+        self.check_button.setAutoDefault(True)
+
+        self.form = QtWidgets.QFormLayout()
+        self.form.addRow(self.magnitude_text, self.magnitude_box)
+        self.form.addRow(self.phase_text, self.phase_box)
+        self.form.addRow(self.points_text, self.points_box)
+        self.hbox = QtWidgets.QHBoxLayout()
+        self.hbox.addWidget(self.record_button)
+        self.hbox.addWidget(self.check_button)
+        self.vbox = QtWidgets.QVBoxLayout()
+        self.vbox.addWidget(self.reference_text)
+        self.vbox.addWidget(self.verdict_text)
+        self.vbox.addWidget(self.detail_text)
+        self.vbox.addLayout(self.form)
+        self.vbox.addLayout(self.hbox)
+        self.setLayout(self.vbox)
+
+        self.magnitude_box.setValue(self.params.qc["magnitude_tolerance"])
+        self.phase_box.setValue(self.params.qc["phase_tolerance"])
+        self.points_box.setValue(self.params.qc["points"])
+        self.magnitude_box.valueChanged.connect(self.set_magnitude_tolerance)
+        self.phase_box.valueChanged.connect(self.set_phase_tolerance)
+        self.points_box.valueChanged.connect(self.set_points)
+        self.record_button.clicked.connect(self.record)
+        self.check_button.clicked.connect(self.check)
+        self.show_reference()
+
+    def show_reference(self):
+        if self.reference is None:
+            self.reference_text.setText("No reference recorded.")
+            return
+        freqs = self.reference.freqs
+        self.reference_text.setText(
+            f"Reference: {len(freqs)} frequencies, {freqs[0]}-{freqs[-1]} Hz, "
+            f"range {self.reference.range}, "
+            f"{self.reference.settling_cycles} settling cycles "
+            f"(~{self.reference.duration * 1000:.0f} ms)"
+        )
+
+    @QtCore.Slot()
+    def set_magnitude_tolerance(self, value):
+        self.params.qc["magnitude_tolerance"] = value
+
+    @QtCore.Slot()
+    def set_phase_tolerance(self, value):
+        self.params.qc["phase_tolerance"] = value
+
+    @QtCore.Slot()
+    def set_points(self, value):
+        self.params.qc["points"] = value
+
+    @QtCore.Slot()
+    def record(self):
+        if not self.impedance.gain_parameters[self.impedance.range]:
+            QtWidgets.QMessageBox.critical(
+                self, "Error", "Selected range is not calibrated."
+            )
+            return
+        logger.debug("recording QC reference")
+        self.reference = qc.record(
+            self.impedance,
+            self.params.sweep["start"],
+            self.params.sweep["increment"],
+            self.params.sweep["points"],
+            self.params.qc["magnitude_tolerance"],
+            self.params.qc["phase_tolerance"],
+            self.params.qc["points"],
+        )
+        try:
+            self.reference.save()
+        except OSError as e:
+            logger.warning(f"could not save QC reference: {e}")
+        self.show_reference()
+
+    @QtCore.Slot()
+    def check(self):
+        if self.reference is None:
+            QtWidgets.QMessageBox.critical(self, "Error", "No reference recorded.")
+            return
+        try:
+            result = qc.check(
+                self.impedance,
+                self.reference,
+                self.params.sweep["start"],
+                self.params.sweep["increment"],
+                self.params.sweep["points"],
+                self.params.qc["points"],
+            )
+        except ValueError as e:
+            QtWidgets.QMessageBox.critical(self, "Error", f"{e}.")
+            return
+        try:
+            part = self.results_log.append(result)
+        except OSError as e:
+            logger.warning(f"could not log QC result: {e}")
+            part = "-"
+        if result["verdict"] == "pass":
+            self.passed += 1
+            self.verdict_text.setStyleSheet("color: green;")
+        else:
+            self.failed += 1
+            self.verdict_text.setStyleSheet("color: red;")
+        self.verdict_text.setText(result["verdict"].upper())
+        unit = "%" if result["quantity"] == "magnitude" else "°"
+        self.detail_text.setText(
+            f"part {part}: worst {result['quantity']} at {result['f']} Hz, "
+            f"{result['deviation']:+.2f} {unit} ({result['margin'] * 100:.0f} % "
+            f"of tolerance), {result['duration'] * 1000:.0f} ms\n"
+            f"{self.passed} passed, {self.failed} failed this session"
+        )
+
+
+class DebugWidget(QtWidgets.QWidget):
+    def __init__(self, impedance: AD5933, health: HealthCollector):
+        super().__init__()
+        self.impedance = impedance
+        self.health = health
+        self.generation = None
         self.text_box = QtWidgets.QTextEdit()
         self.text_box.setReadOnly(True)
         try:
@@ -587,66 +1415,90 @@ class DebugWidget(QtWidgets.QWidget):
         except KeyError:
             self.text_box.setFont(QtGui.QFont("monospace"))
 
+        self.trace_check = QtWidgets.QCheckBox("Trace acquisition pipeline")
+        self.trace_check.setChecked(metrics.enabled())
+        self.reset_button = QtWidgets.QPushButton("Reset metrics")
+
         self.layout = QtWidgets.QVBoxLayout()
         self.layout.addWidget(self.text_box)
+        self.hbox = QtWidgets.QHBoxLayout()
+        self.hbox.addWidget(self.trace_check)
+        self.hbox.addWidget(self.reset_button)
+        self.layout.addLayout(self.hbox)
         self.setLayout(self.layout)
 
+        self.trace_check.stateChanged.connect(self.toggle_tracing)
+        self.reset_button.clicked.connect(self.reset_metrics)
+        self.render_timer = QtCore.QTimer()
+        self.render_timer.timeout.connect(self.render)
+
     @QtCore.Slot()
-    def update(self, index):
-        # TODO: make this more elegant
-        if index == 3:
-            command = dedent(
-                r"""\
-            show(){
-                local _NAME="$*"
-                echo "$_NAME"
-                for _ in $(seq "${#_NAME}"); do
-                   printf '%s' =
-                done
-                printf '\n'
-                eval "$@"
-                printf '\n'
-            }
-            commands(){
-                show systemctl status impedance
-                show uptime
-                show ip address show dev wlan0
-                show /sbin/iwconfig wlan0
-                show journalctl -b -n 10 -p warning
-            }
-            if command -v aha >/dev/null; then
-                SYSTEMD_COLORS=1 commands | aha -n -x | sed 'a <br/>'
-            else
-                commands
-            fi
-            """
-            )
-            out = subprocess.run("sh", capture_output=True, text=True, input=command)
-            if out.stderr:
-                logger.debug(f"shell stderr: {out.stderr}")
-            self.text_box.setHtml(out.stdout)
+    def toggle_tracing(self, value):
+        metrics.enable(bool(value))
+        logger.debug(f"tracing {'enabled' if value else 'disabled'}")
+
+    @QtCore.Slot()
+    def reset_metrics(self):
+        metrics.reset()
+
+    @QtCore.Slot()
+    def update(self, shown):
+        if shown:
+            self.health.request()
+            self.render()
+            self.render_timer.start(RENDER_INTERVAL)
+        else:
+            self.render_timer.stop()
+
+    @QtCore.Slot()
+    def render(self):
+        if self.health.generation == self.generation:
+            return
+        self.generation = self.health.generation
+        scroll_bar = self.text_box.verticalScrollBar()
+        position = scroll_bar.value()
+        self.text_box.setHtml(self.health.html)
+        scroll_bar.setValue(position)
 
 
 class MainWidget(QtWidgets.QTabWidget):
     def __init__(self):
         super().__init__()
-        self.impedance = AD5933()
-        self.thermo = MCP9600()
-        # for _ in range(5):
-        #     try:
-        #         self.thermo.enable_filter(TCOUPLE_FILTER)
-        #         logger.debug(f"setting thermocouple filter to level {TCOUPLE_FILTER}")
-        #         break
-        #     except OSError:
-        #         sleep(1)
-        self.data_logger = DataLogger()
+        self.boards = [Board(**board) for board in find_boards()] or [Board()]
+        for board in self.boards:
+            board.start()
+        # the first board is operated interactively
+        self.impedance = self.boards[0].impedance
+        try:
+            journal = Journal()
+        except OSError as e:
+            logger.warning(f"continuous runs are not journaled: {e}")
+            journal = None
+        self.data_logger = DataLogger(journal)
+        recovered = self.data_logger.recover()
+        if recovered:
+            logger.warning(f"recovered {recovered} continuous samples from journal")
+            QtCore.QTimer.singleShot(
+                0,
+                lambda: QtWidgets.QMessageBox.information(
+                    self,
+                    "Recovered",
+                    f"Recovered {recovered} samples of an interrupted continuous "
+                    "measurement, see the Export tab.",
+                ),
+            )
         self.sweep = SweepWidget(self.impedance, self.data_logger)
         self.continuous = ContinuousWidget(
-            self.impedance, self.thermo, self.data_logger
+            self.impedance, self.boards[0], self.data_logger, self.boards[1:]
         )
         self.setup = SetupWidget(self.impedance)
         self.export = ExportWidget(self.impedance, self.data_logger)
-        self.debug = DebugWidget(self.impedance)
+        self.qc = QCWidget(self.impedance)
+        self.health = HealthCollector(
+            self.data_logger, [board.thermo for board in self.boards]
+        )
+        self.health.start()
+        self.debug = DebugWidget(self.impedance, self.health)
         self.sweep_shortcut = QtWidgets.QShortcut("F1", self)
         self.continuous_shortcut = QtWidgets.QShortcut("F2", self)
         self.setup_shortcut = QtWidgets.QShortcut("F3", self)
@@ -656,16 +1508,41 @@ class MainWidget(QtWidgets.QTabWidget):
         self.addTab(self.continuous, "Continuous")
         self.addTab(self.setup, "Setup")
         self.addTab(self.export, "Export")
+        self.addTab(self.qc, "QC")
         self.addTab(self.debug, "Debug")
 
         self.sweep_shortcut.activated.connect(self.sweep_pressed)
         self.continuous_shortcut.activated.connect(self.continuous_pressed)
         self.setup_shortcut.activated.connect(self.setup_pressed)
         self.trigger_shortcut.activated.connect(self.trigger_pressed)
+        self.sweep.busy.connect(self.set_busy)
         self.currentChanged.connect(self.setup.range_widget.update)
-        self.currentChanged.connect(self.debug.update)
+        self.currentChanged.connect(self.tab_changed)
         self.currentChanged.connect(self.export.update)
 
+        self.metrics_timer = QtCore.QTimer()
+        self.metrics_timer.timeout.connect(self.write_metrics)
+        self.metrics_timer.start(METRICS_INTERVAL * 1000)
+
+    @QtCore.Slot()
+    def write_metrics(self):
+        if metrics.enabled():
+            try:
+                metrics.write()
+            except OSError as e:
+                logger.debug(f"could not write metrics: {e}")
+
+    @QtCore.Slot()
+    def set_busy(self, busy):
+        # nothing else may use the device while a sweep runs
+        self.sweep.cal_button.setEnabled(not busy)
+        for widget in (self.continuous, self.setup, self.qc):
+            self.setTabEnabled(self.indexOf(widget), not busy)
+
+    @QtCore.Slot()
+    def tab_changed(self, index):
+        self.debug.update(index == self.indexOf(self.debug))
+
     @QtCore.Slot()
     def sweep_pressed(self):
         self.setCurrentWidget(self.sweep)
@@ -684,10 +1561,18 @@ class MainWidget(QtWidgets.QTabWidget):
             self.sweep.meas_button.animateClick(0)
         elif self.currentWidget() is self.continuous:
             self.continuous.start_button.animateClick(1000)
+        elif self.currentWidget() is self.qc:
+            self.qc.check_button.animateClick(0)
 
     def closeEvent(self, event):
         logger.debug("closing ...")
+        self.sweep.close()
         self.continuous.close()
+        for board in self.boards:
+            board.stop()
+        self.health.stop()
+        if self.data_logger.journal is not None:
+            self.data_logger.journal.close(complete=True)
         event.accept()
 
 